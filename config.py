@@ -7,6 +7,7 @@ class DefaultConfig(object):
     def __init__(self):
         self.prepare = False
         self.build = False
+        self.force_prepare = False
         self.train = False
         self.evaluate = False
         self.case = False
@@ -22,14 +23,24 @@ class DefaultConfig(object):
         self.layer_dropout = 0.3
         self.batch_train = 32
         self.batch_eval = 64
+        self.accumulate_steps = 1
         self.epochs = 10
         self.optim = 'Adam'
         self.patience = 2
         self.period = 1000
         self.num_threads = 8
+        self.num_workers = 1
+        self.pin_memory = True
+        self.dynamic_pad = False
+        self.bucket_pool = 50
+        self.precision = 'fp32'
         self.max_len = {'full': 128, 'pre': 64, 'alt': 8, 'cur': 64}
         self.w2v_type = 'wiki'
+        self.min_count = 1
+        self.max_vocab = None
         self.n_emb = 300
+        self.shared_embedding = False
+        self.decomposed_relation = False
         self.n_hidden = 64
         self.n_layer = 2
         self.n_block = 4
@@ -54,6 +65,7 @@ class DefaultConfig(object):
         self.transfer_file2 = '2010_full_filtered.json'
         self.raw_dir = 'data/raw_data/'
         self.processed_dir = 'data/processed_data/torch'
+        self.token_cache_file = 'data/processed_data/token_cache.sqlite'
         self.outputs_dir = 'outputs/'
         self.model_dir = 'models/'
         self.result_dir = 'results/'
@@ -85,12 +97,12 @@ class DefaultConfig(object):
             if not op.exists(dir_path):
                 os.makedirs(dir_path)
 
-        # Run record file...
-        self.train_record_file = op.join(self.processed_dir, 'train.pkl')
-        self.valid_record_file = op.join(self.processed_dir, 'valid.pkl')
-        self.test_record_file = op.join(self.processed_dir, 'test.pkl')
-        self.transfer_record_file1 = op.join(self.processed_dir, 'transfer1.pkl')
-        self.transfer_record_file2 = op.join(self.processed_dir, 'transfer2.pkl')
+        # Run record dirs, one memmap per field...
+        self.train_record_dir = op.join(self.processed_dir, 'train_records')
+        self.valid_record_dir = op.join(self.processed_dir, 'valid_records')
+        self.test_record_dir = op.join(self.processed_dir, 'test_records')
+        self.transfer_record_dir1 = op.join(self.processed_dir, 'transfer_records1')
+        self.transfer_record_dir2 = op.join(self.processed_dir, 'transfer_records2')
         #  Count file...
         self.train_meta = op.join(self.processed_dir, 'train_meta.json')
         self.valid_meta = op.join(self.processed_dir, 'valid_meta.json')
@@ -98,6 +110,7 @@ class DefaultConfig(object):
         self.transfer_meta1 = op.join(self.processed_dir, 'transfer_meta1.json')
         self.transfer_meta2 = op.join(self.processed_dir, 'transfer_meta2.json')
         self.shape_meta = op.join(self.processed_dir, 'shape_meta.json')
+        self.stage_file = op.join(self.processed_dir, 'prepare_stages.json')
 
         self.train_annotation = op.join(self.processed_dir, 'train_annotations.txt')
         self.valid_annotation = op.join(self.processed_dir, 'valid_annotations.txt')
@@ -106,18 +119,19 @@ class DefaultConfig(object):
         self.corpus_file = op.join(self.processed_dir, 'corpus.txt')
         self.token_emb_file = op.join(self.processed_dir, 'token_emb.pkl')
         self.token2id_file = op.join(self.processed_dir, 'token2id.json')
+        self.token_count_file = op.join(self.processed_dir, 'token_counts.json')
         self.id2token_file = op.join(self.processed_dir, 'id2token.json')
         # Word Embedding...
         if self.w2v_type == 'wiki':
-            self.w2v_file = './data/processed_data/wiki.en.pkl'
+            self.w2v_file = './data/processed_data/wiki.en.store'
         elif self.w2v_type == 'google':
-            self.w2v_file = './data/processed_data/google.news.pkl'
+            self.w2v_file = './data/processed_data/google.news.store'
         elif self.w2v_type == 'glove6':
-            self.w2v_file = './data/processed_data/glove.6B.pkl'
+            self.w2v_file = './data/processed_data/glove.6B.store'
         elif self.w2v_type == 'glove840':
-            self.w2v_file = './data/processed_data/glove.840B.pkl'
+            self.w2v_file = './data/processed_data/glove.840B.store'
         elif self.w2v_type == 'fastText':
-            self.w2v_file = './data/processed_data/fastText.pkl'
+            self.w2v_file = './data/processed_data/fastText.store'
 
 
 opt = DefaultConfig()
@@ -1,8 +1,3 @@
-from .torch_MCKNAli import MCDN
-from .torch_MCKN import SCRN
+from .torch_MCKN import MCKN
 from .torch_TransBlocks import TB
 from .torch_TextCNN import TextCNN
-from .torch_TextRNN import TextRNN
-from .torch_DPCNN import TextCNNDeep
-from .tencent_DPCNN import DPCNN
-from .torch_DRNN import DRNN
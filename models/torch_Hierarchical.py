@@ -1,9 +1,11 @@
 import torch
 from torch import nn
-from torch.nn import utils as nn_utils
 from modules.torch_CNN import TemporalConvNet
 from modules.torch_attention import Multihead_Attention, FeedForward, PositionEmbedding, WordEmbedding, label_smoothing
-from modules.torch_TextCNNNet import TextCNNNet
+from modules.torch_TextCNNNet import TextCNNNet, segment_mask
+from modules.torch_embedding import gather_segments
+from modules.torch_relation import relation_pairs
+from modules.torch_recurrent import PackedGRU, last_state
 # from sru import SRU
 from time import time
 
@@ -43,10 +45,16 @@ class TCN(nn.Module):
         return self.linear(y)
 
 class Hierarchical(nn.Module):
+    # The output layer flattens max_len * hidden, batches must keep their full width...
+    fixed_length = True
+
     def __init__(self, token_embeddings, max_len, output_size, n_hidden, n_layer, n_kernels, n_filter, n_block, n_head,
-                 is_ffn, dropout, logger):
+                 is_ffn, dropout, logger, shared_embedding=False, masked_pool=False, decomposed_relation=False):
         super(Hierarchical, self).__init__()
         start_t = time()
+        self.shared_embedding = shared_embedding
+        self.masked_pool = masked_pool
+        self.decomposed_relation = decomposed_relation
         self.gru_hidden = n_hidden
         self.att_hidden = 2 * n_hidden
         self.crn_hidden = 4 * n_hidden
@@ -59,7 +67,7 @@ class Hierarchical(nn.Module):
         self.word_embedding = nn.Embedding(n_dict, n_emb, padding_idx=0)
         self.emb_dropout = nn.Dropout(dropout['emb'])
 
-        self.word_encoder = nn.GRU(n_emb, n_hidden, n_layer, dropout=dropout['layer'], bidirectional=True)
+        self.word_encoder = PackedGRU(n_emb, n_hidden, n_layer, dropout=dropout['layer'], bidirectional=True)
         # self.seg_encoder = nn.GRU(n_emb, n_hidden, n_layer, dropout=dropout['layer'], batch_first=True, bidirectional=True)
         # self.sentence_encoder = SRU(n_emb, n_hidden, n_layer, dropout['layer'], weight_norm=True, layer_norm=True,
         # bidirectional=True)
@@ -91,28 +99,35 @@ class Hierarchical(nn.Module):
         self._init_weights(token_embeddings)
         logger.info('Time to build graph: {} s'.format(time() - start_t))
 
+    @classmethod
+    def from_args(cls, token_embeddings, args, logger):
+        # Builds the model from the config like MCKN does, so config flags such as shared_embedding reach it...
+        return cls(token_embeddings, args.max_len, args.n_class, args.n_hidden, args.n_layer, args.n_kernels,
+                   args.n_filter, args.n_block, args.n_head, args.is_ffn, args.dropout, logger,
+                   shared_embedding=args.shared_embedding, masked_pool=args.dynamic_pad,
+                   decomposed_relation=args.decomposed_relation)
+
     def _init_weights(self, embeddings):
         self.word_embedding.weight.data.copy_(torch.from_numpy(embeddings))
         self.word_embedding.weight.requires_grad = False
 
-    def forward(self, x, x_pre, x_alt, x_cur, seq_lens):
+    def forward(self, x, x_pre, x_alt, x_cur, seq_lens, seg_starts=None):
         batch_size = x.shape[0]
-        sorted_seq_lens, indices = torch.sort(seq_lens, dim=0, descending=True)
-        _, desorted_indices = torch.sort(indices, descending=False)
-        x = x[indices]
         x_word_emb = self.word_embedding(x)
-        x_pre_word_emb = self.word_embedding(x_pre)
-        x_alt_word_emb = self.word_embedding(x_alt)
-        x_cur_word_emb = self.word_embedding(x_cur)
+        if self.shared_embedding and seg_starts is not None:
+            x_pre_word_emb, x_alt_word_emb, x_cur_word_emb = gather_segments(x_word_emb, [x_pre, x_alt, x_cur],
+                                                                             seg_starts)
+        else:
+            x_pre_word_emb = self.word_embedding(x_pre)
+            x_alt_word_emb = self.word_embedding(x_alt)
+            x_cur_word_emb = self.word_embedding(x_cur)
         x_word_emb = self.emb_dropout(x_word_emb)
         x_pre_word_emb = self.emb_dropout(x_pre_word_emb)
         x_alt_word_emb = self.emb_dropout(x_alt_word_emb)
         x_cur_word_emb = self.emb_dropout(x_cur_word_emb)
 
-        # x_word_emb = nn_utils.rnn.pack_padded_sequence(x_word_emb, sorted_seq_lens, batch_first=True)
-        output, state = self.word_encoder(x_word_emb.permute(1, 0, 2))
-
-        y_encoder = output.permute(1, 0, 2)
+        # Outputs past each sentence end are zero, so the attention key masks skip the padding...
+        y_encoder, state = self.word_encoder(x_word_emb, seq_lens)
         for i in range(self.n_block):
             y_encoder = self.__getattr__('self_attention_%d' % i)(y_encoder)
             if self.is_ffn:
@@ -125,24 +140,25 @@ class Hierarchical(nn.Module):
         # state = state.view(self.n_layer, 2, batch_size, self.gru_hidden)
         # forward_state, backward_state = state[-1][0], state[-1][1]
         # y_state = torch.cat([forward_state, backward_state], dim=1)
-        state = state.view(self.n_layer, 2, batch_size, self.gru_hidden)
-        forward_state, backward_state = state[-1][0], state[-1][1]
-        y_state = torch.cat([forward_state, backward_state], dim=1)
-        y_pre = self.pre_encoder(x_pre_word_emb)
-        y_alt = self.alt_encoder(x_alt_word_emb)
-        y_cur = self.cur_encoder(x_cur_word_emb)
-        pre_cur = torch.cat((y_pre, y_cur), dim=1)
-        cur_pre = torch.cat((y_cur, y_pre), dim=1)
-        pre_alt = torch.cat((y_pre, y_alt), dim=1)
-        alt_cur = torch.cat((y_alt, y_cur), dim=1)
-        y_composed = torch.stack([pre_cur, cur_pre, pre_alt, alt_cur], dim=1)
-        y_state = torch.unsqueeze(y_state, 1)
-        y_state = y_state.repeat(1, 4, 1)
-        y_pair = torch.cat([y_composed, y_state], 2)
-
-        y_pair = y_pair.view(batch_size * 4, 6 * self.n_filter + 2 * self.gru_hidden)
-        y_pair = self.g_fc(y_pair)
-        y_pair = y_pair.view(batch_size, 4, self.crn_hidden)
+        y_state = last_state(state, self.n_layer, batch_size, self.gru_hidden)
+        y_pre = self.pre_encoder(x_pre_word_emb, segment_mask(x_pre) if self.masked_pool else None)
+        y_alt = self.alt_encoder(x_alt_word_emb, segment_mask(x_alt) if self.masked_pool else None)
+        y_cur = self.cur_encoder(x_cur_word_emb, segment_mask(x_cur) if self.masked_pool else None)
+        if self.decomposed_relation:
+            y_pair = relation_pairs(self.g_fc, [y_pre, y_alt, y_cur], y_state)
+        else:
+            pre_cur = torch.cat((y_pre, y_cur), dim=1)
+            cur_pre = torch.cat((y_cur, y_pre), dim=1)
+            pre_alt = torch.cat((y_pre, y_alt), dim=1)
+            alt_cur = torch.cat((y_alt, y_cur), dim=1)
+            y_composed = torch.stack([pre_cur, cur_pre, pre_alt, alt_cur], dim=1)
+            y_state = torch.unsqueeze(y_state, 1)
+            y_state = y_state.repeat(1, 4, 1)
+            y_pair = torch.cat([y_composed, y_state], 2)
+
+            y_pair = y_pair.view(batch_size * 4, 6 * self.n_filter + 2 * self.gru_hidden)
+            y_pair = self.g_fc(y_pair)
+            y_pair = y_pair.view(batch_size, 4, self.crn_hidden)
         y_pair = y_pair.sum(1).squeeze()
         y_segment = self.f_fc(y_pair)
 
@@ -151,10 +167,15 @@ class Hierarchical(nn.Module):
 
 
 class Hierarchical_1(nn.Module):
+    # The output layer flattens max_len * hidden, batches must keep their full width...
+    fixed_length = True
+
     def __init__(self, token_embeddings, max_len, output_size, n_level, n_hidden, n_layer, n_kernels, n_filter,
-                 n_block, n_head, is_ffn, dropout, logger):
+                 n_block, n_head, is_ffn, dropout, logger, masked_pool=False, decomposed_relation=False):
         super(Hierarchical_1, self).__init__()
         start_t = time()
+        self.masked_pool = masked_pool
+        self.decomposed_relation = decomposed_relation
         self.gru_hidden = n_hidden
         self.att_hidden = 2 * n_hidden
         self.crn_hidden = 4 * n_hidden
@@ -168,7 +189,7 @@ class Hierarchical_1(nn.Module):
         self.emb_dropout = nn.Dropout(dropout['emb'])
 
         self.tcn = TemporalConvNet(n_emb, [self.crn_hidden] * n_level, kernel_size=3, dropout=dropout['layer'])
-        self.seg_encoder = nn.GRU(n_emb, n_hidden, n_layer, dropout=dropout['layer'], batch_first=True, bidirectional=True)
+        self.seg_encoder = PackedGRU(n_emb, n_hidden, n_layer, dropout=dropout['layer'], bidirectional=True)
         # self.sentence_encoder = SRU(n_emb, n_hidden, n_layer, dropout['layer'], weight_norm=True, layer_norm=True,
         #                             bidirectional=True)
         for i in range(self.n_block):
@@ -202,11 +223,8 @@ class Hierarchical_1(nn.Module):
         self.word_embedding.weight.data.copy_(torch.from_numpy(embeddings))
         self.word_embedding.weight.requires_grad = False
 
-    def forward(self, x, x_pre, x_alt, x_cur, seq_lens):
+    def forward(self, x, x_pre, x_alt, x_cur, seq_lens, seg_starts=None):
         batch_size = x.shape[0]
-        sorted_seq_lens, indices = torch.sort(seq_lens, dim=0, descending=True)
-        _, desorted_indices = torch.sort(indices, descending=False)
-        x = x[indices]
         x_word_emb = self.word_embedding(x)
         x_pre_word_emb = self.word_embedding(x_pre)
         x_alt_word_emb = self.word_embedding(x_alt)
@@ -226,26 +244,26 @@ class Hierarchical_1(nn.Module):
         y_word = torch.reshape(y_encoder, [-1, self.max_len * self.crn_hidden])
         y_word = self.word_fc(y_word)
 
-        x_word_emb = nn_utils.rnn.pack_padded_sequence(x_word_emb, sorted_seq_lens, batch_first=True)
-        output, state = self.seg_encoder(x_word_emb)
-        state = state.view(self.n_layer, 2, batch_size, self.gru_hidden)
-        forward_state, backward_state = state[-1][0], state[-1][1]
-        y_state = torch.cat([forward_state, backward_state], dim=1)
-        y_pre = self.pre_encoder(x_pre_word_emb)
-        y_alt = self.alt_encoder(x_alt_word_emb)
-        y_cur = self.cur_encoder(x_cur_word_emb)
-        pre_cur = torch.cat((y_pre, y_cur), dim=1)
-        cur_pre = torch.cat((y_cur, y_pre), dim=1)
-        pre_alt = torch.cat((y_pre, y_alt), dim=1)
-        alt_cur = torch.cat((y_alt, y_cur), dim=1)
-        y_composed = torch.stack([pre_cur, cur_pre, pre_alt, alt_cur], dim=1)
-        y_state = torch.unsqueeze(y_state, 1)
-        y_state = y_state.repeat(1, 4, 1)
-        y_pair = torch.cat([y_composed, y_state], 2)
-
-        y_pair = y_pair.view(batch_size * 4, 6 * self.n_filter + 2 * self.gru_hidden)
-        y_pair = self.g_fc(y_pair)
-        y_pair = y_pair.view(batch_size, 4, self.crn_hidden)
+        output, state = self.seg_encoder(x_word_emb, seq_lens)
+        y_state = last_state(state, self.n_layer, batch_size, self.gru_hidden)
+        y_pre = self.pre_encoder(x_pre_word_emb, segment_mask(x_pre) if self.masked_pool else None)
+        y_alt = self.alt_encoder(x_alt_word_emb, segment_mask(x_alt) if self.masked_pool else None)
+        y_cur = self.cur_encoder(x_cur_word_emb, segment_mask(x_cur) if self.masked_pool else None)
+        if self.decomposed_relation:
+            y_pair = relation_pairs(self.g_fc, [y_pre, y_alt, y_cur], y_state)
+        else:
+            pre_cur = torch.cat((y_pre, y_cur), dim=1)
+            cur_pre = torch.cat((y_cur, y_pre), dim=1)
+            pre_alt = torch.cat((y_pre, y_alt), dim=1)
+            alt_cur = torch.cat((y_alt, y_cur), dim=1)
+            y_composed = torch.stack([pre_cur, cur_pre, pre_alt, alt_cur], dim=1)
+            y_state = torch.unsqueeze(y_state, 1)
+            y_state = y_state.repeat(1, 4, 1)
+            y_pair = torch.cat([y_composed, y_state], 2)
+
+            y_pair = y_pair.view(batch_size * 4, 6 * self.n_filter + 2 * self.gru_hidden)
+            y_pair = self.g_fc(y_pair)
+            y_pair = y_pair.view(batch_size, 4, self.crn_hidden)
         y_pair = y_pair.sum(1).squeeze()
         y_segment = self.f_fc(y_pair)
 
@@ -254,9 +272,10 @@ class Hierarchical_1(nn.Module):
 
 class MCKN(nn.Module):
     def __init__(self, token_embeddings, max_len, output_size, n_hidden, n_layer, n_kernels, n_filter,
-                 n_block, n_head, is_sinusoid, is_ffn, dropout, logger):
+                 n_block, n_head, is_sinusoid, is_ffn, dropout, logger, masked_pool=False):
         super(MCKN, self).__init__()
         start_t = time()
+        self.masked_pool = masked_pool
         n_dict, n_emb = token_embeddings.shape
         self.sinusoid = is_sinusoid
         #self.gru_hidden = n_hidden
@@ -269,12 +288,12 @@ class MCKN(nn.Module):
         self.n_filter = n_filter
         self.word_embedding = nn.Embedding(n_dict, n_emb, padding_idx=0)
         if is_sinusoid:
-            self.position_embedding = PositionEmbedding(n_emb, zeros_pad=False, scale=False)
+            self.position_embedding = PositionEmbedding(n_emb, zeros_pad=False, scale=False, max_len=self.max_len)
         else:
             self.position_embedding = WordEmbedding(self.max_len, n_emb, zeros_pad=False, scale=False)
         self.emb_dropout = nn.Dropout(dropout['emb'])
 
-        self.seg_encoder = nn.GRU(n_emb, n_hidden, n_layer, dropout=dropout['layer'], batch_first=True, bidirectional=True)
+        self.seg_encoder = PackedGRU(n_emb, n_hidden, n_layer, dropout=dropout['layer'], bidirectional=True)
         # for i in range(self.n_block):
         #     self.__setattr__('self_attention_%d' % i, Multihead_Attention(self.att_hidden, n_head, dropout['layer']))
         #     if self.is_ffn:
@@ -306,11 +325,8 @@ class MCKN(nn.Module):
         self.word_embedding.weight.data.copy_(torch.from_numpy(embeddings))
         self.word_embedding.weight.requires_grad = False
 
-    def forward(self, x, x_pre, x_alt, x_cur, seq_lens):
+    def forward(self, x, x_pre, x_alt, x_cur, seq_lens, seg_starts=None):
         batch_size = x.shape[0]
-        sorted_seq_lens, indices = torch.sort(seq_lens, dim=0, descending=True)
-        _, desorted_indices = torch.sort(indices, descending=False)
-        x = x[indices]
         x_word_emb = self.word_embedding(x)
         x_pre_word_emb = self.word_embedding(x_pre)
         x_alt_word_emb = self.word_embedding(x_alt)
@@ -322,7 +338,7 @@ class MCKN(nn.Module):
         if self.sinusoid:
             x_word_emb += self.position_embedding(x)
         else:
-            x_word_emb += self.position_embedding(torch.unsqueeze(torch.arange(0, x.size()[1]), 0).repeat(x.size(0), 1).long().cuda())
+            x_word_emb += self.position_embedding(torch.arange(x.size(1), device=x.device).unsqueeze(0).expand(x.size(0), -1))
         # y_encoder = self.emb_dropout(x_word_emb)
         # for i in range(self.n_block):
         #     y_encoder = self.__getattr__('self_attention_%d' % i)(y_encoder)
@@ -336,9 +352,9 @@ class MCKN(nn.Module):
        # state = state.view(self.n_layer, 2, batch_size, self.gru_hidden)
        # forward_state, backward_state = state[-1][0], state[-1][1]
        # y_state = torch.cat([forward_state, backward_state], dim=1)
-        y_pre = self.pre_encoder(x_pre_word_emb)
-        y_alt = self.alt_encoder(x_alt_word_emb)
-        y_cur = self.cur_encoder(x_cur_word_emb)
+        y_pre = self.pre_encoder(x_pre_word_emb, segment_mask(x_pre) if self.masked_pool else None)
+        y_alt = self.alt_encoder(x_alt_word_emb, segment_mask(x_alt) if self.masked_pool else None)
+        y_cur = self.cur_encoder(x_cur_word_emb, segment_mask(x_cur) if self.masked_pool else None)
         pre_cur = torch.cat((y_pre, y_cur), dim=1)
         cur_pre = torch.cat((y_cur, y_pre), dim=1)
         pre_alt = torch.cat((y_pre, y_alt), dim=1)
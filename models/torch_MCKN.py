@@ -1,8 +1,10 @@
 import torch
 from torch import nn
-from torch.nn import utils as nn_utils
 from modules.torch_transformer import PositionalEncoding
-from modules.torch_TextCNNNet import TextCNNNet
+from modules.torch_TextCNNNet import TextCNNNet, segment_mask
+from modules.torch_embedding import gather_segments
+from modules.torch_relation import relation_pairs
+from modules.torch_recurrent import PackedGRU, last_state
 from time import time
 
 
@@ -13,20 +15,26 @@ class MCKN(nn.Module):
         n_dict, n_emb = token_embeddings.shape   # shape mean size...
         self.max_len = args.max_len['full']
         self.att_hidden = n_emb
-        #self.gru_hidden = args.n_hidden
+        self.gru_hidden = args.n_hidden
         self.crn_hidden = 4 * args.n_hidden   # crn mean Causality Relation Network...
         self.n_layer = args.n_layer
         self.n_filter = args.n_filter
         self.n_kernels = args.n_kernels
         self.is_sinusoid = args.is_sinusoid
         self.is_ffn = args.is_ffn
+        self.shared_embedding = args.shared_embedding
+        # Padding only enters the max pool of trimmed batches, full width batches pool as older checkpoints did...
+        self.masked_pool = args.dynamic_pad
+        self.decomposed_relation = args.decomposed_relation
 
         self.word_embedding = nn.Embedding(n_dict, n_emb, padding_idx=0)
         if self.is_sinusoid:
             self.position_embedding = PositionalEncoding(n_emb, max_len=self.max_len)
         self.emb_dropout = nn.Dropout(args.dropout['emb'])
 
-
+    # Bidirectional GRU over the full sentence, its final state is appended to every object pair...
+        self.sentence_encoder = PackedGRU(n_emb, self.gru_hidden, self.n_layer, dropout=args.dropout['layer'],
+                                          bidirectional=True)
 
     # TextCNNNet (mean 3 column k-oriented net) of three level for pre,alt, and cur segments..
         self.pre_encoder = TextCNNNet(n_emb, args.max_len['pre'], self.n_filter, self.n_kernels)
@@ -59,18 +67,18 @@ class MCKN(nn.Module):
         self.word_embedding.weight.data.copy_(torch.from_numpy(embeddings))
         self.word_embedding.weight.requires_grad = False
 
-    def forward(self, x, x_pre, x_alt, x_cur, seq_lens):
+    def forward(self, x, x_pre, x_alt, x_cur, seq_lens, seg_starts=None):
         batch_size = x.shape[0]
-        sorted_seq_lens, indices = torch.sort(seq_lens, dim=0, descending=True)
-
-        _, desorted_indices = torch.sort(indices, descending=False)
-        x = x[indices]
 
-    # Word and Segment embedding...
+    # Word and Segment embedding, with shared_embedding the segments are cut out of the sentence embeddings...
         x_word_emb = self.word_embedding(x)
-        x_pre_word_emb = self.word_embedding(x_pre)
-        x_alt_word_emb = self.word_embedding(x_alt)
-        x_cur_word_emb = self.word_embedding(x_cur)
+        if self.shared_embedding and seg_starts is not None:
+            x_pre_word_emb, x_alt_word_emb, x_cur_word_emb = gather_segments(x_word_emb, [x_pre, x_alt, x_cur],
+                                                                             seg_starts)
+        else:
+            x_pre_word_emb = self.word_embedding(x_pre)
+            x_alt_word_emb = self.word_embedding(x_alt)
+            x_cur_word_emb = self.word_embedding(x_cur)
 
     # Apply dropout on each segment...
         x_pre_word_emb = self.emb_dropout(x_pre_word_emb)
@@ -82,35 +90,40 @@ class MCKN(nn.Module):
             x_word_emb += self.position_embedding(x_word_emb)
         x_word_emb = self.emb_dropout(x_word_emb)
 
-    # apply rnn.pack_padded_seq on the input x_word_emb...
-        x_word_emb = nn_utils.rnn.pack_padded_sequence(x_word_emb, sorted_seq_lens, batch_first=True)
+    # Encode the sentence over its real length only, y_state is the (batch, 2 * gru_hidden) final state in batch order...
+        output, state = self.sentence_encoder(x_word_emb, seq_lens)
+        y_state = last_state(state, self.n_layer, batch_size, self.gru_hidden)
 
     # Create the y_pre, y_alt, and y_cur by passing them to TextCNNNet(mean 3 column k-oriented net) encoder network
-        y_pre = self.pre_encoder(x_pre_word_emb)
-        y_alt = self.alt_encoder(x_alt_word_emb)
-        y_cur = self.cur_encoder(x_cur_word_emb)
-
-    # Construct four object pair by Concatenating Relation b/w pre-cur, cur-pre, pre-alt, and alt-cur...
-        pre_cur = torch.cat((y_pre, y_cur), dim=1)
-        cur_pre = torch.cat((y_cur, y_pre), dim=1)
-        pre_alt = torch.cat((y_pre, y_alt), dim=1)
-        alt_cur = torch.cat((y_alt, y_cur), dim=1)
-
-    # Make stack of all relations pairs...
-        y_composed = torch.stack([pre_cur, cur_pre, pre_alt, alt_cur], dim=1)
-        y_state = torch.unsqueeze(y_state, 1)
-        y_state = y_state.repeat(1, 4, 1)   # from 1 to 4 increase by 1.....
-
-    # Concatenate y_composed and y_state...and reshape it by using view function...y_pair = OP in paper eq.(7),in paper.
-    # Reshape...
-        y_pair = torch.cat([y_composed, y_state], 2)
-        y_pair = y_pair.view(batch_size * 4, 6 * self.n_filter + 2 * self.gru_hidden)
-
-    # pass y_pair (OP) to g_fc function of Causality Relation Network(CRN)...
-        y_pair = self.g_fc(y_pair)
-
-    # Change the shape of y_pair (OP)...
-        y_pair = y_pair.view(batch_size, 4, self.crn_hidden)
+        y_pre = self.pre_encoder(x_pre_word_emb, segment_mask(x_pre) if self.masked_pool else None)
+        y_alt = self.alt_encoder(x_alt_word_emb, segment_mask(x_alt) if self.masked_pool else None)
+        y_cur = self.cur_encoder(x_cur_word_emb, segment_mask(x_cur) if self.masked_pool else None)
+
+        if self.decomposed_relation:
+            # The same (batch, 4, crn_hidden) OP from per-object projections, without building the pairs...
+            y_pair = relation_pairs(self.g_fc, [y_pre, y_alt, y_cur], y_state)
+        else:
+        # Construct four object pair by Concatenating Relation b/w pre-cur, cur-pre, pre-alt, and alt-cur...
+            pre_cur = torch.cat((y_pre, y_cur), dim=1)
+            cur_pre = torch.cat((y_cur, y_pre), dim=1)
+            pre_alt = torch.cat((y_pre, y_alt), dim=1)
+            alt_cur = torch.cat((y_alt, y_cur), dim=1)
+
+        # Make stack of all relations pairs...
+            y_composed = torch.stack([pre_cur, cur_pre, pre_alt, alt_cur], dim=1)
+            y_state = torch.unsqueeze(y_state, 1)
+            y_state = y_state.repeat(1, 4, 1)   # from 1 to 4 increase by 1.....
+
+        # Concatenate y_composed and y_state...and reshape it by using view function...y_pair = OP in paper eq.(7),in paper.
+        # Reshape...
+            y_pair = torch.cat([y_composed, y_state], 2)
+            y_pair = y_pair.view(batch_size * 4, 6 * self.n_filter + 2 * self.gru_hidden)
+
+        # pass y_pair (OP) to g_fc function of Causality Relation Network(CRN)...
+            y_pair = self.g_fc(y_pair)
+
+        # Change the shape of y_pair (OP)...
+            y_pair = y_pair.view(batch_size, 4, self.crn_hidden)
 
     # Sum y_pair in dim 1...
         y_pair = y_pair.sum(1).squeeze()
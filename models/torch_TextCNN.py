@@ -1,14 +1,16 @@
 import torch
 from torch import nn
-from modules.torch_TextCNNNet import TextCNNNet
+from modules.torch_TextCNNNet import TextCNNNet, length_mask
 from modules.torch_attention import PositionEmbedding, WordEmbedding
 from time import time
 
 class TextCNN(nn.Module):
     def __init__(self, token_embeddings, max_len, output_size, n_kernels, n_filter, is_pos, is_sinusoid,
-                 dropout, logger):
+                 dropout, logger, masked_pool=False):
         super(TextCNN, self).__init__()
         start_t = time()
+        # Padding only enters the max pool with masked_pool, off by default so older checkpoints score the same...
+        self.masked_pool = masked_pool
         n_dict, n_emb = token_embeddings.shape # size of embedding...
         self.sinusoid = is_sinusoid
         self.max_len = max_len['full']
@@ -17,7 +19,7 @@ class TextCNN(nn.Module):
         self.is_pos = is_pos
         self.word_embedding = nn.Embedding(n_dict, n_emb, padding_idx=0)
         if is_sinusoid:
-            self.position_embedding = PositionEmbedding(n_emb, zeros_pad=False, scale=False)
+            self.position_embedding = PositionEmbedding(n_emb, zeros_pad=False, scale=False, max_len=self.max_len)
         else:
             self.position_embedding = WordEmbedding(self.max_len, n_emb, zeros_pad=False, scale=False)
         self.emb_dropout = nn.Dropout(dropout['emb'])
@@ -38,7 +40,7 @@ class TextCNN(nn.Module):
         self.word_embedding.weight.data.copy_(torch.from_numpy(embeddings))
         self.word_embedding.weight.requires_grad = False
 
-    def forward(self, x, x_pre, x_alt, x_cur, seq_lens):
+    def forward(self, x, x_pre, x_alt, x_cur, seq_lens, seg_starts=None):
         x_emb = self.word_embedding(x)
         x_emb = self.emb_dropout(x_emb)
 
@@ -47,10 +49,10 @@ class TextCNN(nn.Module):
                 x_emb += self.position_embedding(x)
             else:
                 x_emb += self.position_embedding(
-                    torch.unsqueeze(torch.arange(0, x.size()[1]), 0).repeat(x.size(0), 1).long().cuda())
+                    torch.arange(x.size(1), device=x.device).unsqueeze(0).expand(x.size(0), -1))
 
     # Pass x_emb to cnn_encoder to produce y...
-        y = self.cnn_encoder(x_emb)
+        y = self.cnn_encoder(x_emb, length_mask(seq_lens, x.size(1)) if self.masked_pool else None)
 
     # pass y to out_fc...
         return self.out_fc(y)
@@ -4,6 +4,9 @@ from modules.torch_transformer import Encoder, PositionalEncoding
 from time import time
 
 class TB(nn.Module):
+    # The output layer flattens max_len * hidden, batches must keep their full width...
+    fixed_length = True
+
     def __init__(self, token_embeddings, args, logger):
         super(TB, self).__init__()
         start_t = time()
@@ -34,7 +37,7 @@ class TB(nn.Module):
         self.word_embedding.weight.data.copy_(torch.from_numpy(embeddings))
         self.word_embedding.weight.requires_grad = False
 
-    def forward(self, x, x_pre, x_alt, x_cur, seq_lens):
+    def forward(self, x, x_pre, x_alt, x_cur, seq_lens, seg_starts=None):
         x_mask = (x != 0).unsqueeze(-2)
 
     # Word embedding...
@@ -1,19 +1,80 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+
+
+def segment_mask(tokens):
+    """
+    Real tokens of a (batch, width) segment, padding ids are 0. A segment that is a single <NULL> (id 0 as well)
+    keeps its first position, so it is pooled like the one token it is.
+    """
+    mask = tokens != 0
+    mask[:, 0] = True
+    return mask
+
+
+def length_mask(seq_lens, width):
+    # The full sentence has stored lengths, which also count a trailing <NULL>...
+    return torch.arange(width, device=seq_lens.device).unsqueeze(0) < seq_lens.clamp(min=1).unsqueeze(1)
 
 
 class TextCNNNet(nn.Module):
     def __init__(self, n_input, max_len, n_output, kernel_sizes, topk=1):
         super(TextCNNNet, self).__init__()
+        # The per kernel modules only hold the parameters, so existing checkpoints keep loading...
         self.convs = nn.ModuleList([nn.Sequential(nn.Conv1d(n_input, n_output, k, padding=k // 2),
                                                   nn.BatchNorm1d(n_output),
-                                                  nn.ReLU(),
-                                                  nn.MaxPool1d(max_len)) for k in kernel_sizes])
+                                                  nn.ReLU()) for k in kernel_sizes])
+        self.max_len = max_len
+        self.n_output = n_output
+        self.kernel_sizes = list(kernel_sizes)
+        # All kernels run as one convolution of fused_width taps, kernel k is zero padded and sits at column
+        # fused_padding - k // 2, so every output position lines up with the one of its own padding=k // 2 conv...
+        self.fused_padding = max(k // 2 for k in self.kernel_sizes)
+        self.offsets = [self.fused_padding - k // 2 for k in self.kernel_sizes]
+        self.fused_width = max(offset + k for offset, k in zip(self.offsets, self.kernel_sizes))
+        # Right padding long enough for the longest per kernel output (seq_len + 1 for even kernels)...
+        extra = max(2 * (k // 2) - k + 1 for k in self.kernel_sizes)
+        self.fused_right = self.fused_width - 1 - self.fused_padding + extra
+
+    def _fused_conv(self):
+        weights, biases = [], []
+        for conv, offset in zip(self.convs, self.offsets):
+            weight = conv[0].weight
+            weights.append(F.pad(weight, [offset, self.fused_width - offset - weight.size(2)]))
+            biases.append(conv[0].bias)
+        return torch.cat(weights, dim=0), torch.cat(biases, dim=0)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
+        """
+        x is (batch, seq_len, n_input) with any seq_len <= max_len. Without a mask the max runs over all seq_len
+        positions, padding included, so a sample's output depends on the width of its batch. With a (batch, seq_len)
+        mask of the real tokens only those positions are pooled, at any width.
+        """
+        seq_len = x.size(1)
         x = x.transpose(2, 1)
-        conv_x = [conv(x) for conv in self.convs]
-        conv_x = torch.cat(conv_x, dim=1)
-        conv_x = conv_x.squeeze()
+        padding = self.fused_padding
+        if self.fused_right != self.fused_padding:
+            x = F.pad(x, [self.fused_padding, self.fused_right])
+            padding = 0
+        weight, bias = self._fused_conv()
+        if self.training:
+            # Batch statistics are taken over the positions of each kernel's own output, as before...
+            y = F.conv1d(x, weight, bias, padding=padding)
+            chunks = torch.split(y, self.n_output, dim=1)
+            y = torch.cat([conv[1](chunk[:, :, :seq_len + 2 * (k // 2) - k + 1])[:, :, :seq_len]
+                           for conv, chunk, k in zip(self.convs, chunks, self.kernel_sizes)], dim=1)
+        else:
+            # In eval the batch norms are folded into the fused weights, one convolution does everything...
+            bns = [conv[1] for conv in self.convs]
+            scale = torch.cat([bn.weight / torch.sqrt(bn.running_var + bn.eps) for bn in bns])
+            shift = torch.cat([bn.bias - bn.running_mean * bn.weight / torch.sqrt(bn.running_var + bn.eps)
+                               for bn in bns])
+            y = F.conv1d(x, weight * scale[:, None, None], bias * scale + shift, padding=padding)
+            y = y[:, :, :seq_len]
+        y = F.relu(y)
+        if mask is not None:
+            # ReLU outputs are never negative, so a zero never wins the max over a real position...
+            y = y.masked_fill(~mask.unsqueeze(1), 0.)
 
-        return conv_x
+        return torch.max(y, dim=2)[0]
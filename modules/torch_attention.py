@@ -1,8 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import *
-import numpy as np
+from modules.torch_transformer import layer_norm
 
 # layer_normalization...
 class layer_normalization(nn.Module):
@@ -17,9 +16,7 @@ class layer_normalization(nn.Module):
         self.beta = nn.Parameter(torch.zeros(features))
 
     def forward(self, x):
-        mean = x.mean(-1, keepdim=True)
-        std = x.std(-1, keepdim=True)
-        return self.gamma * (x - mean) / (std + self.epsilon) + self.beta
+        return layer_norm(x, self.gamma, self.beta, self.epsilon)
 
 # Word embedding class...
 class WordEmbedding(nn.Module):
@@ -56,54 +53,54 @@ class WordEmbedding(nn.Module):
         if self.scale:
             outputs = outputs * (self.num_units ** 0.5)
 
-        return outputs.cuda()
+        return outputs
 
 # PositionEmbedding class....
 class PositionEmbedding(nn.Module):
-    def __init__(self, num_units, zeros_pad=True, scale=True):
+    def __init__(self, num_units, zeros_pad=True, scale=True, max_len=512):
 
         '''Sinusoidal Positional_Encoding.
         Args:
           num_units: Output dimensionality
           zero_pad: Boolean. If True, all the values of the first row (id = 0) should be constant zero
           scale: Boolean. If True, the output will be multiplied by sqrt num_units(check details from paper)
+          max_len: Number of positions cached at build time, longer inputs grow the table on first use.
         '''
 
         super(PositionEmbedding, self).__init__()
         self.num_units = num_units
         self.zeros_pad = zeros_pad
         self.scale = scale
+        # The table never changes, so it is built once and follows the module to its device, not kept in checkpoints...
+        self.register_buffer('lookup_table', self._build_table(max_len), persistent=False)
 
-    def forward(self, inputs):
-        # inputs: A 2d Tensor with shape of (N, T).
-        N, T = inputs.size()[0: 2]
-
+    def _build_table(self, max_len, device=None):
         # First part of the PE function: sin and cos argument
-        position_ind = Variable(torch.unsqueeze(torch.arange(0, T), 0).repeat(N, 1).long())
-        position_enc = torch.Tensor([
-            [pos / np.power(10000, 2. * i / self.num_units) for i in range(self.num_units)]
-            for pos in range(T)])
+        position = torch.arange(max_len, dtype=torch.float64, device=device).unsqueeze(1)
+        div_term = torch.pow(10000., 2. * torch.arange(self.num_units, dtype=torch.float64, device=device) / self.num_units)
+        position_enc = (position / div_term).float()
 
         # Second part, apply the cosine to even columns and sin to odds.
         position_enc[:, 0::2] = torch.sin(position_enc[:, 0::2])  # dim 2i
         position_enc[:, 1::2] = torch.cos(position_enc[:, 1::2])  # dim 2i+1
 
-        # Convert to a Variable
-        lookup_table = Variable(position_enc)
-
         if self.zeros_pad:
-            lookup_table = torch.cat((Variable(torch.zeros(1, self.num_units)), lookup_table[1: , :]), 0)
-            padding_idx = 0
-        else:
-            padding_idx = -1
-        outputs = F.embedding(position_ind, lookup_table, padding_idx, None, 2, False, False)
-        # outputs = self._backend.Embedding.apply(
-        #     position_ind, lookup_table, padding_idx, None, 2, False, False)  # copied from torch.nn.modules.sparse.py
+            position_enc[0].fill_(0)
+        return position_enc
+
+    def forward(self, inputs):
+        # inputs: A 2d Tensor with shape of (N, T).
+        N, T = inputs.size()[0: 2]
+        if T > self.lookup_table.size(0):
+            self.lookup_table = self._build_table(T, self.lookup_table.device).to(self.lookup_table.dtype)
+
+        # Every row looks up positions 0..T-1, so the table rows are broadcast over the batch...
+        outputs = self.lookup_table[:T].unsqueeze(0).expand(N, T, self.num_units)
 
         if self.scale:
             outputs = outputs * self.num_units ** 0.5
 
-        return outputs.cuda()
+        return outputs
 
 # Multihead_Attention class....
 class Multihead_Attention(nn.Module):
@@ -154,26 +151,17 @@ class Multihead_Attention(nn.Module):
         # Scale...
         outputs = outputs / (K_.size()[-1] ** 0.5)
 
-        # Key Masking
+        # Key Masking, -2 ** 32 + 1 is beyond the range of half precision, which masks with its own minimum...
+        mask_value = max(-2 ** 32 + 1, torch.finfo(outputs.dtype).min)
         key_masks = torch.sign(torch.abs(torch.sum(mini_batch, dim=-1)))  # (N, T_k)
         key_masks = key_masks.repeat(self.num_heads, 1)  # (h*N, T_k)
-        key_masks = torch.unsqueeze(key_masks, 1).repeat(1, mini_batch.size()[1], 1)  # (h*N, T_q, T_k)
-
-        padding = Variable(torch.ones(*outputs.size()).cuda() * (-2 ** 32 + 1))
-        condition = key_masks.eq(0.).float()
-        outputs = padding * condition + outputs * (1. - condition)
+        outputs = outputs.masked_fill(key_masks.eq(0.).unsqueeze(1), mask_value)  # (h*N, T_q, T_k)
 
         # Causality = Future blinding
         if self.causality:
-            diag_vals = torch.ones(*outputs[0, :, :].size()) .cuda() # (T_q, T_k)
-            tril = torch.tril(diag_vals, diagonal = 0)  # (T_q, T_k)
-
-            # print(tril)
-            masks = Variable(torch.unsqueeze(tril, 0).repeat(outputs.size()[0], 1, 1))  # (h*N, T_q, T_k)
-
-            padding = Variable(torch.ones(*masks.size()).cuda() * (-2 ** 32 + 1))
-            condition = masks.eq(0.).float()
-            outputs = padding * condition + outputs * (1. - condition)
+            T_q, T_k = outputs.size()[1:]
+            future = torch.ones(T_q, T_k, dtype=torch.bool, device=outputs.device).triu(diagonal=1)  # (T_q, T_k)
+            outputs = outputs.masked_fill(future, mask_value)
 
         # Activation
         outputs = F.softmax(outputs, dim=-1)  # (h*N, T_q, T_k)
@@ -182,8 +170,7 @@ class Multihead_Attention(nn.Module):
         # Query Masking
         query_masks = torch.sign(torch.abs(torch.sum(mini_batch, dim=-1)))  # (N, T_q)
         query_masks = query_masks.repeat(self.num_heads, 1)  # (h*N, T_q)
-        query_masks = torch.unsqueeze(query_masks, 2).repeat(1, 1, mini_batch.size()[1])  # (h*N, T_q, T_k)
-        outputs = outputs * query_masks
+        outputs = outputs * query_masks.unsqueeze(2)  # (h*N, T_q, T_k)
 
         # Dropouts
         outputs = self.output_dropout(outputs)  # (h*N, T_q, T_k)
@@ -0,0 +1,28 @@
+import torch
+
+
+def gather_segments(x_emb, segments, seg_starts, rows=None):
+    """
+    Cuts the pre, alt and cur segment embeddings out of the already embedded full sentence instead of looking the
+    segment tokens up in the embedding table a second time.
+    Args:
+        x_emb: (batch, seq_len, n_emb) embeddings of the full sentence.
+        segments: token ids of every segment, (batch, width) each, only used to find their padding.
+        seg_starts: (batch, n_segment) start of every segment inside the full sentence, stored at prepare time.
+        rows: row of x_emb holding sample b, for models that sorted x by length before embedding it.
+    Returns:
+        A tuple with one (batch, width, n_emb) tensor per segment. Padding positions are zero like the padding row
+        of the embedding table, positions cut off by the max_len of the full sentence are zero as well.
+    """
+    batch_size, seq_len, n_emb = x_emb.size()
+    if rows is None:
+        rows = torch.arange(batch_size, device=x_emb.device)
+    widths = [segment.size(1) for segment in segments]
+    positions = torch.cat([seg_starts[:, i:i + 1] + torch.arange(width, device=x_emb.device)
+                           for i, width in enumerate(widths)], dim=1)
+    mask = (torch.cat(segments, dim=1) != 0) & (positions < seq_len)
+    # All segments are read with a single gather over the flattened sentence embeddings...
+    flat = rows.unsqueeze(1) * seq_len + positions.clamp(max=seq_len - 1)
+    gathered = x_emb.reshape(batch_size * seq_len, n_emb)[flat.view(-1)].view(batch_size, -1, n_emb)
+    gathered = gathered.masked_fill(~mask.unsqueeze(-1), 0.)
+    return torch.split(gathered, widths, dim=1)
@@ -0,0 +1,39 @@
+import torch
+from torch import nn
+from torch.nn import utils as nn_utils
+
+
+class PackedGRU(nn.GRU):
+    """
+    Batch first GRU that only runs over the real tokens of every row. The batch is packed by length, so the recurrent
+    compute scales with the sentence lengths instead of the padded width, and both the output and the final state
+    come back in the original batch order. Being a plain nn.GRU subclass, its parameters keep the nn.GRU names and
+    checkpoints of the former encoders load unchanged.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs['batch_first'] = True
+        super(PackedGRU, self).__init__(*args, **kwargs)
+
+    def forward(self, inputs, seq_lens):
+        """
+        Args:
+            inputs: (batch, seq_len, n_input) padded inputs.
+            seq_lens: (batch,) number of real tokens of every row.
+        Returns:
+            output: (batch, seq_len, n_direction * hidden_size), zero past the end of every row.
+            state: (n_layer * n_direction, batch, hidden_size), the state after the last real token of every row.
+        """
+        # pack_padded_sequence sorts the rows itself and the packed GRU returns its state in the input order.
+        # Empty rows still get one step, as the packed format has no zero length rows...
+        lengths = seq_lens.clamp(min=1, max=inputs.size(1)).cpu()
+        packed = nn_utils.rnn.pack_padded_sequence(inputs, lengths, batch_first=True, enforce_sorted=False)
+        output, state = super(PackedGRU, self).forward(packed)
+        output, _ = nn_utils.rnn.pad_packed_sequence(output, batch_first=True, total_length=inputs.size(1))
+        return output, state
+
+
+def last_state(state, n_layer, batch_size, hidden_size):
+    # Forward and backward states of the top layer side by side, (batch, 2 * hidden_size)...
+    state = state.view(n_layer, 2, batch_size, hidden_size)
+    return torch.cat([state[-1][0], state[-1][1]], dim=1)
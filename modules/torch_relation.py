@@ -0,0 +1,32 @@
+import torch
+import torch.nn.functional as F
+
+# Objects are ordered (pre, alt, cur), the four relations are pre-cur, cur-pre, pre-alt and alt-cur...
+RELATION_PAIRS = [(0, 2), (2, 0), (0, 1), (1, 2)]
+
+
+def relation_pairs(g_fc, objects, state, pairs=RELATION_PAIRS):
+    """
+    Same result as stacking torch.cat([objects[a], objects[b], state]) for every pair (a, b) and running g_fc over
+    the batch * n_pairs rows, without building those rows. The first linear layer of g_fc is split into the blocks
+    seen by the first object, the second object and the state: each object is projected once by the first two
+    blocks in a single matmul, the state once by the third, and the pair activations are sums of those projections.
+    Args:
+        g_fc: nn.Sequential starting with the nn.Linear over [first object, second object, state].
+        objects: list of (batch, n_object) tensors.
+        state: (batch, n_state) tensor shared by all pairs.
+    Returns:
+        (batch, n_pairs, n_out) output of g_fc for every pair.
+    """
+    linear = g_fc[0]
+    n_object = objects[0].size(1)
+    w_first, w_second, w_state = torch.split(linear.weight, [n_object, n_object, linear.in_features - 2 * n_object],
+                                             dim=1)
+    # (batch, n_objects, 2 * n_out), the first half as first object of a pair, the second half as second object...
+    projected = torch.matmul(torch.stack(objects, dim=1), torch.cat([w_first, w_second], dim=0).t())
+    first, second = torch.split(projected, linear.out_features, dim=2)
+    shared = F.linear(state, w_state, linear.bias).unsqueeze(1)
+    first_idx = [a for a, _ in pairs]
+    second_idx = [b for _, b in pairs]
+    y_pair = first[:, first_idx] + second[:, second_idx] + shared
+    return g_fc[1:](y_pair)
@@ -44,6 +44,21 @@ class EncoderLayer(nn.Module):
         return self.sublayer[1](x, self.feed_forward)
 
 
+def layer_norm(x, a_2, b_2, eps):
+    """
+    a_2 * (x - mean) / (std + eps) + b_2 with the unbiased std, computed by the fused F.layer_norm kernel.
+    F.layer_norm divides by sqrt(biased var + eps) instead, so a_2 is rescaled by sqrt((n - 1) / n) and eps is
+    passed as eps ** 2 * (n - 1) / n, which turns its denominator into sqrt(unbiased var + eps ** 2). The two agree
+    exactly for constant rows and up to a relative eps / std otherwise. The normalized outputs reach about 5, so they
+    differ by up to about 5 * eps / std: with the eps of 1e-6 of LayerNorm 5e-6 at std 1, 5e-5 at std 0.1 and 5e-4
+    at std 0.01, with the eps of 1e-8 of layer_normalization at most 6e-6 down to std 0.01. Rows of a smaller std
+    drift further, tmp/layernorm_benchmark.py prints the difference per std. Parameters keep their names and shapes.
+    """
+    n = x.size(-1)
+    scale = math.sqrt((n - 1) / n)
+    return F.layer_norm(x, (n,), a_2 * scale, b_2, eps * eps * (n - 1) / n)
+
+
 class LayerNorm(nn.Module):
     "Construct a layernorm module (See citation for details)."
 
@@ -54,9 +69,7 @@ class LayerNorm(nn.Module):
         self.eps = eps
 
     def forward(self, x):
-        mean = x.mean(-1, keepdim=True)
-        std = x.std(-1, keepdim=True)
-        return self.a_2 * (x - mean) / (std + self.eps) + self.b_2
+        return layer_norm(x, self.a_2, self.b_2, self.eps)
 
 
 class SublayerConnection(nn.Module):
@@ -106,6 +119,8 @@ class MultiHeadedAttention(nn.Module):
         self.linears = clones(nn.Linear(d_model, d_model), 4)  # the attention head h = 4.
         self.attn = None
         self.dropout = nn.Dropout(p=dropout)
+        # The attention weights are only kept in self.attn when capture is set, draw_att sets it...
+        self.capture = False
 
     def forward(self, query, key, value, mask=None):
         "Implements Figure 2"
@@ -115,11 +130,26 @@ class MultiHeadedAttention(nn.Module):
         nbatches = query.size(0)
 
         # 1) Apply all linear projections in batch from d_model => h x d_k.
-        query, key, value = [l(x).view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
-                             for l, x in zip(self.linears, (query, key, value))]
+        if query is key and key is value:
+            # Self attention projects q, k and v with a single matmul over the three stacked weights...
+            weight = torch.cat([l.weight for l in self.linears[:3]], dim=0)
+            bias = torch.cat([l.bias for l in self.linears[:3]], dim=0)
+            qkv = F.linear(query, weight, bias).view(nbatches, -1, 3, self.h, self.d_k)
+            query, key, value = qkv.permute(2, 0, 3, 1, 4).unbind(0)
+        else:
+            query, key, value = [l(x).view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
+                                 for l, x in zip(self.linears, (query, key, value))]
 
         # 2) Apply attention on all the projected vectors in batch.
-        x, self.attn = attention(query, key, value, mask=mask, dropout=self.dropout)
+        if self.capture or not hasattr(F, 'scaled_dot_product_attention'):
+            x, self.attn = attention(query, key, value, mask=mask, dropout=self.dropout)
+        else:
+            self.attn = None
+            if mask is not None:
+                # An additive mask keeps the -1e9 of attention, so a row without any key stays uniform, not nan...
+                mask = torch.zeros(mask.size(), dtype=query.dtype, device=query.device).masked_fill(mask == 0, max(-1e9, torch.finfo(query.dtype).min))
+            x = F.scaled_dot_product_attention(query, key, value, attn_mask=mask,
+                                               dropout_p=self.dropout.p if self.training else 0.)
 
         # 3) "Concat" using a view and apply a final linear.
         x = x.transpose(1, 2).contiguous().view(nbatches, -1, self.h * self.d_k)
@@ -0,0 +1,72 @@
+import os
+import hashlib
+import ujson as json
+
+# Bump when a stage starts producing different outputs for the same inputs...
+PREPARE_VERSION = 3
+HASH_BLOCK = 1 << 20
+
+
+def hash_file(path):
+    """
+    Content hash of a raw input file.
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(HASH_BLOCK), b''):
+            sha.update(block)
+    fh.close()
+    return sha.hexdigest()
+
+
+def stat_file(path):
+    """
+    Cheap identity of a huge file (the pretrained vectors), path, size and modification time instead of a full hash.
+    """
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, int(st.st_mtime)]
+
+
+def fingerprint(*parts):
+    return hashlib.sha1(json.dumps([PREPARE_VERSION] + list(parts)).encode('utf8')).hexdigest()
+
+
+class StageManifest(object):
+    """
+    Remembers the fingerprint each prepare stage was last built from. A stage is fresh when its fingerprint is
+    unchanged and all of its outputs are still on disk.
+    """
+
+    def __init__(self, manifest_file, force=False):
+        self.manifest_file = manifest_file
+        self.stages = {}
+        if not force and os.path.exists(manifest_file):
+            with open(manifest_file, 'r') as fh:
+                self.stages = json.load(fh)
+            fh.close()
+
+    def is_fresh(self, stage, stage_fp, outputs):
+        fresh = self.stages.get(stage) == stage_fp and all(os.path.exists(path) for path in outputs)
+        if fresh:
+            print('Stage {} is up to date, skipped'.format(stage))
+        return fresh
+
+    def _write(self):
+        # Write to a temporary file first, an interrupted prepare must not leave a broken manifest...
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as fh:
+            json.dump(self.stages, fh)
+        fh.close()
+        os.replace(tmp_file, self.manifest_file)
+
+    def invalidate(self, stage):
+        """
+        Called before a stage overwrites its outputs, so a crash half way never leaves it looking fresh.
+        """
+        if stage in self.stages:
+            del self.stages[stage]
+            self._write()
+
+    def mark(self, stage, stage_fp):
+        self.stages[stage] = stage_fp
+        self._write()
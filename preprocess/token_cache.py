@@ -0,0 +1,71 @@
+import os
+import hashlib
+import sqlite3
+import ujson as json
+import nltk
+
+# Cached tokens are only valid for the tokenizer that produced them...
+TOKENIZER_VERSION = 'nltk-word_tokenize-' + nltk.__version__
+QUERY_CHUNK = 500
+
+
+def text_key(text):
+    return hashlib.sha1(text.encode('utf8')).hexdigest()
+
+
+class TokenCache(object):
+    """
+    Persistent word_tokenize cache stored in a local SQLite file and keyed by the sha1 of the segment text,
+    so re-running --prepare only tokenizes segments it has never seen.
+    """
+
+    def __init__(self, cache_file):
+        cache_dir = os.path.dirname(cache_file)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_file = cache_file
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(cache_file)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, tokens TEXT)')
+        row = self.conn.execute("SELECT value FROM meta WHERE name = 'tokenizer'").fetchone()
+        if row is None or row[0] != TOKENIZER_VERSION:
+            # A different tokenizer may split differently, start from an empty cache...
+            self.conn.execute('DELETE FROM tokens')
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('tokenizer', ?)", (TOKENIZER_VERSION,))
+        self.conn.commit()
+
+    def get_many(self, texts):
+        """
+        Returns a dict from text to its cached tokens for every text found in the cache.
+        """
+        keys = {}
+        for text in texts:
+            keys[text_key(text)] = text
+        found = {}
+        key_list = list(keys)
+        for i in range(0, len(key_list), QUERY_CHUNK):
+            chunk = key_list[i:i + QUERY_CHUNK]
+            query = 'SELECT key, tokens FROM tokens WHERE key IN ({})'.format(','.join('?' * len(chunk)))
+            for key, tokens in self.conn.execute(query, chunk):
+                found[keys[key]] = json.loads(tokens)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, texts, tokenized):
+        self.conn.executemany('INSERT OR REPLACE INTO tokens VALUES (?, ?)',
+                              [(text_key(text), json.dumps(tokens)) for text, tokens in zip(texts, tokenized)])
+        self.conn.commit()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def report(self):
+        print('Token cache {}: {} hits {} misses, hit rate {:.2%}'.format(self.cache_file, self.hits, self.misses,
+                                                                            self.hit_rate()))
+
+    def close(self):
+        self.conn.close()
@@ -1,6 +1,8 @@
 import os
+import multiprocessing
+from itertools import chain, islice
+from collections import Counter
 import pickle as pkl
-from tqdm import tqdm
 import numpy as np
 from scipy import stats
 import matplotlib.pyplot as plt
@@ -9,10 +11,15 @@ import ujson as json
 import nltk
 from nltk.tokenize import word_tokenize
 from time import time
+from utils.record_util import create_records, close_records, HEADER_FILE
+from preprocess.token_cache import TokenCache, TOKENIZER_VERSION
+from preprocess.prepare_stages import StageManifest, hash_file, stat_file, fingerprint
+from preprocess.vector_store import load_vectors, resolve_vectors, stamp_file
 
 np.random.seed(int(time()))
 
 SPACE = ' '
+TOKENIZE_CHUNK = 2000
 
 
 def stat_length(seq_length):
@@ -104,11 +111,47 @@ def check_null(sen):
     return pre, mid, cur, flag
 
 
-def preprocess_train(file_path, file_name, data_type, is_build=False):
+def _tokenize_chunk(texts):
+    return [word_tokenize(text) for text in texts]
+
+
+def tokenize_texts(texts, num_workers=1, cache=None):
+    # Every distinct text is tokenized once, looked up in the persistent cache first when one is given...
+    unique_texts = list(dict.fromkeys(texts))
+    tokenized = cache.get_many(unique_texts) if cache is not None else {}
+    missing = [text for text in unique_texts if text not in tokenized]
+    # Chunks are tokenized by a process pool, Pool.map keeps the chunk order so the output matches the serial path...
+    if num_workers <= 1 or len(missing) <= TOKENIZE_CHUNK:
+        results = [_tokenize_chunk(missing)]
+    else:
+        chunks = [missing[i:i + TOKENIZE_CHUNK] for i in range(0, len(missing), TOKENIZE_CHUNK)]
+        pool = multiprocessing.Pool(processes=num_workers)
+        try:
+            results = pool.map(_tokenize_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    missing_tokens = [tokens for chunk in results for tokens in chunk]
+    if cache is not None:
+        cache.put_many(missing, missing_tokens)
+    tokenized.update(zip(missing, missing_tokens))
+    return [tokenized[text] for text in texts]
+
+
+def tokenize_groups(groups, num_workers=1, cache=None):
+    # Flattens a list of segment lists, tokenizes all segments in one pass and restores the nesting...
+    tokens = tokenize_texts([text for group in groups for text in group], num_workers, cache)
+    tokenized, start = [], 0
+    for group in groups:
+        tokenized.append(tokens[start:start + len(group)])
+        start += len(group)
+    return tokenized
+
+
+def preprocess_train(file_path, file_name, data_type, is_build=False, num_workers=1, cache=None):
     print("Generating {} examples...".format(data_type))
     examples = []
-    engs, sims = [], []
-    seg_engs, seg_sims, labels = [], [], []
+    rows, labels = [], []
 
     data_path = os.path.join(file_path, file_name)
     lines = open(data_path, 'r', encoding='ISO-8859-1').readlines()
@@ -118,11 +161,18 @@ def preprocess_train(file_path, file_name, data_type, is_build=False):
             continue
         labels.append(int(line[0]))
         del line[0]
-        if is_build:
-            engs.append(word_tokenize(SPACE.join(line[:3]).strip()))
-            sims.append(word_tokenize(SPACE.join(line[3:]).strip()))
-        seg_engs.append([word_tokenize(seg) for seg in line[:3]])
-        seg_sims.append([word_tokenize(seg) for seg in line[3:]])
+        rows.append(line)
+
+    # English and simple wiki segments, plus the joined sentences when building the corpus...
+    groups = [line[:3] for line in rows] + [line[3:] for line in rows]
+    if is_build:
+        groups += [[SPACE.join(line[:3]).strip()] for line in rows] + [[SPACE.join(line[3:]).strip()] for line in rows]
+    tokenized = tokenize_groups(groups, num_workers, cache)
+    n_row = len(rows)
+    seg_engs, seg_sims = tokenized[:n_row], tokenized[n_row:2 * n_row]
+    if is_build:
+        engs = [group[0] for group in tokenized[2 * n_row:3 * n_row]]
+        sims = [group[0] for group in tokenized[3 * n_row:]]
 
     english_punctuations = [',', '.', ':', ';', '?', '(', ')', '[', ']', '&', '!', '*', '@', '#', '$', '%',
                             '"', '``', '-', '\'\'']
@@ -176,10 +226,10 @@ def preprocess_train(file_path, file_name, data_type, is_build=False):
 
 # Pre processing of test dataset....
 
-def preprocess_test(file_path, file_name, data_type, is_build=False):
+def preprocess_test(file_path, file_name, data_type, is_build=False, num_workers=1, cache=None):
     print("Generating {} examples...".format(data_type))
     examples = []
-    sentences, segments, labels = [], [], []
+    rows, labels = [], []
     data_path = os.path.join(file_path, file_name)
     lines = open(data_path, 'r', encoding='ISO-8859-1').readlines()
     for line in lines:
@@ -187,12 +237,17 @@ def preprocess_test(file_path, file_name, data_type, is_build=False):
         num = int(line[-1])
         del line[-1]
         labels.append(0 if num == 0 else 1)
-        sentences.append(word_tokenize(SPACE.join(line).strip()))
-
-        if len(line) == 3:
-            segments.append([word_tokenize(seg) for seg in line])
-        else:
-            segments.append([['<NULL>'], word_tokenize(line[0]), word_tokenize(line[1])])
+        rows.append(line)
+
+    # Whole sentences first, then the segments of every row...
+    groups = [[SPACE.join(line).strip()] for line in rows]
+    groups += [line if len(line) == 3 else line[:2] for line in rows]
+    tokenized = tokenize_groups(groups, num_workers, cache)
+    n_row = len(rows)
+    sentences = [group[0] for group in tokenized[:n_row]]
+    segments = []
+    for line, segs in zip(rows, tokenized[n_row:]):
+        segments.append(segs if len(line) == 3 else [['<NULL>']] + segs)
 
     english_punctuations = [',', '.', ':', ';', '?', '(', ')', '[', ']', '&', '!', '*', '@', '#', '$', '%',
                             '"', '``', '-', '\'\'']
@@ -248,19 +303,57 @@ def preprocess_transfer(file_path, file_name, data_type, is_build=False):
                          'cau_label': label})
     return examples
 
-def build_dict(data_path):
-    dictionary = {}
+def _count_chunk(lines):
+    counts = Counter()
+    for line in lines:
+        counts.update(line.strip().split(' '))
+    return counts
+
+
+def _line_chunks(data_path, chunk_size):
     with open(data_path, 'r', encoding='utf8') as fh:
-        for line in fh:
-            line = line.strip().split(' ')
-            fredist = nltk.FreqDist(line)     # Frequency distribution...
-            for localkey in fredist.keys():
-                if localkey in dictionary.keys():
-                    dictionary[localkey] = dictionary[localkey] + fredist[localkey]
-                else:
-                    # If it doesn't exist in the dictionary
-                    dictionary[localkey] = fredist[localkey]  # Add current word frequency to dictionary
-    return set(dictionary)
+        while True:
+            lines = list(islice(fh, chunk_size))
+            if len(lines) == 0:
+                break
+            yield lines
+    fh.close()
+
+
+def count_tokens(data_path, num_workers=1):
+    """
+    Token frequencies of the corpus file, counted chunk by chunk while the file is streamed.
+    """
+    counts = Counter()
+    if num_workers > 1:
+        # Counting is commutative, chunks are merged in whatever order the workers finish them...
+        with multiprocessing.Pool(num_workers) as pool:
+            for chunk_counts in pool.imap_unordered(_count_chunk, _line_chunks(data_path, TOKENIZE_CHUNK)):
+                counts.update(chunk_counts)
+    else:
+        for lines in _line_chunks(data_path, TOKENIZE_CHUNK):
+            counts.update(_count_chunk(lines))
+    return counts
+
+
+def cut_vocab(counts, min_count=1, max_vocab=None):
+    """
+    Keeps the tokens seen at least min_count times, and at most the max_vocab most frequent of them.
+    """
+    kept = [token for token, count in counts.items() if count >= min_count]
+    if max_vocab is not None and len(kept) > max_vocab:
+        # Ties are broken by the token itself so the cut is the same on every run...
+        kept = sorted(kept, key=lambda token: (-counts[token], token))[:max_vocab]
+    print('Kept {} of {} tokens with min_count {} max_vocab {}'.format(len(kept), len(counts), min_count,
+                                                                        max_vocab))
+    return set(kept)
+
+
+def build_dict(data_path, num_workers=1, min_count=1, max_vocab=None, count_file=None):
+    counts = count_tokens(data_path, num_workers)
+    if count_file is not None:
+        save(count_file, dict(counts.most_common()), message='token counts')
+    return cut_vocab(counts, min_count, max_vocab)
 
 # saving the preprocess file...
 def save(filename, obj, message=None):
@@ -278,6 +371,18 @@ def save(filename, obj, message=None):
         fh.close()
 
 
+def _combined_rows(combined_tokens, token2id):
+    # Sub-token rows of every hyphen compound with at least one known part, flattened with the group starts...
+    compounds, sub_rows, starts = [], [], []
+    for token in combined_tokens:
+        rows = [token2id[t] for t in token.split('-') if token2id.get(t, 0) > 1]
+        if len(rows) > 0:
+            compounds.append(token)
+            starts.append(len(sub_rows))
+            sub_rows.extend(rows)
+    return compounds, np.asarray(sub_rows, dtype=np.int64), np.asarray(starts, dtype=np.int64)
+
+
 def get_embedding(data_type, corpus_dict, emb_file=None, vec_size=None):
     print("Generating {} embedding...".format(data_type))
 
@@ -285,49 +390,41 @@ def get_embedding(data_type, corpus_dict, emb_file=None, vec_size=None):
     token2id = {'<NULL>': 0, '<OOV>': 1}
     if emb_file is not None:
         assert vec_size is not None
-        with open(emb_file, 'rb') as fin:
-            trained_embeddings = pkl.load(fin)
-        fin.close()
-        embedding_dict = set(trained_embeddings)
         print('Num of tokens in corpus {}'.format(len(corpus_dict)))
-        filtered_tokens = corpus_dict.intersection(embedding_dict)  # common
+        # Only the rows of corpus tokens are read from the pretrained vectors...
+        found, found_vectors = load_vectors(emb_file, corpus_dict)
+        order = np.argsort(found, kind='stable')
+        filtered_tokens = [found[i] for i in order]  # common
         oov_tokens = corpus_dict.difference(filtered_tokens)
-        combined_tokens = []
-        for token in oov_tokens:
-            if len(token.split('-')) > 1:
-                combined_tokens.append(token)
-        combined_tokens = set(combined_tokens)
-        # oov_tokens = oov_tokens.difference(combined_tokens)
-        # token2id = {'<NULL>': 0, '<OOV>': 1}
-        # embedding_mat = np.zeros([len(corpus_dict) + 2, vec_size])
-        embedding_mat = np.zeros([len(filtered_tokens) + len(token2id), vec_size])
+        combined_tokens = sorted(token for token in oov_tokens if len(token.split('-')) > 1)
         for token in filtered_tokens:
             token2id[token] = len(token2id)
-            embedding_mat[token2id[token]] = trained_embeddings[token]
-
-        combined = 0
-        for tokens in combined_tokens:
-            sub_tokens = tokens.split('-')
-            token_vec = np.zeros([vec_size])
-            in_emb = 0
-            for t in sub_tokens:
-                if t in filtered_tokens:
-                    token_vec += trained_embeddings[t]
-                    in_emb += 1
-            if in_emb > 0:
-                combined += 1
-                token2id[tokens] = len(token2id)
-                embedding_mat = np.row_stack((embedding_mat, token_vec / in_emb))
+        compounds, sub_rows, starts = _combined_rows(combined_tokens, token2id)
+
+        # The matrix is allocated once, known tokens first and the hyphen compounds after them...
+        n_known = len(token2id)
+        embedding_mat = np.zeros([n_known + len(compounds), vec_size], dtype=np.float32)
+        if len(filtered_tokens) > 0:
+            embedding_mat[2:n_known] = found_vectors[order]
+        del found_vectors
+        if len(compounds) > 0:
+            # A compound is the mean of its known sub-token vectors...
+            counts = np.diff(np.append(starts, len(sub_rows)))
+            sums = np.add.reduceat(embedding_mat[sub_rows], starts, axis=0)
+            embedding_mat[n_known:] = sums / counts[:, None]
+            for token in compounds:
+                token2id[token] = len(token2id)
         scale = 3.0 / max(1.0, (len(corpus_dict) + vec_size) / 2.0)
         embedding_mat[1] = np.random.uniform(-scale, scale, vec_size)
         print('Filtered_tokens: {} Combined_tokens: {} OOV_tokens: {}'.format(len(filtered_tokens),
-                                                                              combined,
+                                                                              len(compounds),
                                                                               len(oov_tokens)))
     else:
         embedding_mat = np.random.uniform(-0.25, 0.25, (len(corpus_dict) + len(token2id), vec_size))
+        embedding_mat = embedding_mat.astype(np.float32)
         embedding_mat[0] = np.zeros(vec_size)
         embedding_mat[1] = np.zeros(vec_size)
-        for token in corpus_dict:
+        for token in sorted(corpus_dict):
             token2id[token] = len(token2id)
     # id2token = dict([val, key] for key, val in token2id.items())
     id2token = dict(zip(token2id.values(), token2id.keys()))
@@ -336,60 +433,7 @@ def get_embedding(data_type, corpus_dict, emb_file=None, vec_size=None):
 
 
 def gen_embedding(data_type, corpus_dict, emb_file=None, vec_size=None):
-    print("Generating {} embedding...".format(data_type))
-
-    # token2id = {'<NULL>': 0, '<OOV>': 1, '<LEARN>': 2}
-    token2id = {'<NULL>': 0, '<OOV>': 1}
-    if emb_file is not None:
-        assert vec_size is not None
-        with open(emb_file, 'rb') as fin:
-            trained_embeddings = pkl.load(fin)
-        fin.close()
-        embedding_dict = set(trained_embeddings)
-        print('Num of tokens in corpus {}'.format(len(corpus_dict)))
-        filtered_tokens = corpus_dict.intersection(embedding_dict)  # common
-        oov_tokens = corpus_dict.difference(filtered_tokens)
-        combined_tokens = []
-        for token in oov_tokens:
-            if len(token.split('-')) > 1:
-                combined_tokens.append(token)
-        combined_tokens = set(combined_tokens)
-        # oov_tokens = oov_tokens.difference(combined_tokens)
-        # token2id = {'<NULL>': 0, '<OOV>': 1}
-        # embedding_mat = np.zeros([len(corpus_dict) + 2, vec_size])
-        embedding_mat = np.zeros([len(filtered_tokens) + len(token2id), vec_size])
-        for token in filtered_tokens:
-            token2id[token] = len(token2id)
-            embedding_mat[token2id[token]] = trained_embeddings[token]
-
-        combined = 0
-        for tokens in combined_tokens:
-            sub_tokens = tokens.split('-')
-            token_vec = np.zeros([vec_size])
-            in_emb = 0
-            for t in sub_tokens:
-                if t in filtered_tokens:
-                    token_vec += trained_embeddings[t]
-                    in_emb += 1
-            if in_emb > 0:
-                combined += 1
-                token2id[tokens] = len(token2id)
-                embedding_mat = np.row_stack((embedding_mat, token_vec / in_emb))
-        scale = 3.0 / max(1.0, (len(corpus_dict) + vec_size) / 2.0)
-        embedding_mat[1] = np.random.uniform(-scale, scale, vec_size)
-        print('Filtered_tokens: {} Combined_tokens: {} OOV_tokens: {}'.format(len(filtered_tokens),
-                                                                              combined,
-                                                                              len(oov_tokens)))
-    else:
-        embedding_mat = np.random.uniform(-0.25, 0.25, (len(corpus_dict) + len(token2id), vec_size))
-        embedding_mat[0] = np.zeros(vec_size)
-        embedding_mat[1] = np.zeros(vec_size)
-        for token in corpus_dict:
-            token2id[token] = len(token2id)
-    # id2token = dict([val, key] for key, val in token2id.items())
-    id2token = dict(zip(token2id.values(), token2id.keys()))
-    # print(len(token2id), len(id2token), len(embedding_mat))
-    return embedding_mat, token2id, id2token
+    return get_embedding(data_type, corpus_dict, emb_file, vec_size)
 
 
 def seg_length(sentences):
@@ -435,64 +479,77 @@ def gen_annotation(segs, max_length, filename, labels, data_type):
         f.close()
 
 
-def build_features(sentences, data_type, max_len, out_file, word2id, annotation_file=None):
+def _resolve_word(word, word2id):
+    for each in (word, word.lower(), word.capitalize(), word.upper()):
+        if each in word2id:
+            return word2id[each]
+    return 1
+
+
+def _flatten_column(token_lists, width):
+    # Truncated tokens of every row in one flat list, plus the length each row keeps...
+    lens = np.fromiter((min(len(tokens), width) for tokens in token_lists), dtype=np.int64, count=len(token_lists))
+    flat = list(chain.from_iterable(tokens[:width] for tokens in token_lists))
+    return flat, lens
+
+
+def _scatter_ids(matrix, ids, lens):
+    # Row i receives ids[starts[i]:starts[i] + lens[i]] in its first lens[i] columns...
+    rows = np.repeat(np.arange(len(lens)), lens)
+    starts = np.cumsum(lens) - lens
+    cols = np.arange(len(ids)) - np.repeat(starts, lens)
+    matrix[rows, cols] = ids
+
+
+def build_features(sentences, data_type, max_len, out_dir, word2id, annotation_file=None):
     print("Processing {} examples...".format(data_type))
-    total = 0
+    total = len(sentences)
     meta = {}
-    samples = []
-    # fh = open(annotation_file, 'r', encoding='utf8')
-    for sentence in tqdm(sentences):
-        total += 1
-        tokens = np.zeros([max_len['full']], dtype=np.int32)
-        tokens_pre = np.zeros([max_len['pre']], dtype=np.int32)
-        tokens_alt = np.zeros([max_len['alt']], dtype=np.int32)
-        tokens_cur = np.zeros([max_len['cur']], dtype=np.int32)
-
-        def _get_word(word):
-            for each in (word, word.lower(), word.capitalize(), word.upper()):
-                if each in word2id:
-                    return word2id[each]
-            return 1
-
-        seq_len = min(len(sentence['tokens']), max_len['full'])
-        pre_len = min(len(sentence['tokens_pre']), max_len['pre'])
-        alt_len = min(len(sentence['tokens_alt']), max_len['alt'])
-        cur_len = min(len(sentence['tokens_cur']), max_len['cur'])
-        for i in range(seq_len):
-            tokens[i] = _get_word(sentence['tokens'][i])
-        for i in range(pre_len):
-            tokens_pre[i] = _get_word(sentence['tokens_pre'][i])
-        for i in range(alt_len):
-            tokens_alt[i] = _get_word(sentence['tokens_alt'][i])
-        for i in range(cur_len):
-            tokens_cur[i] = _get_word(sentence['tokens_cur'][i])
-        samples.append({'id': sentence['eid'],
-                        'tokens': tokens,
-                        'tokens_pre': tokens_pre,
-                        'tokens_alt': tokens_alt,
-                        'tokens_cur': tokens_cur,
-                        'length': seq_len,
-                        'cau_label': sentence['cau_label']})
-    # fh.close()
-    with open(out_file, 'wb') as fo:
-        pkl.dump(samples, fo)
-    fo.close()
+    # One memmap per field, filled a whole column at a time...
+    columns = create_records(out_dir, total, max_len)
+    fields = [('tokens', 'full'), ('tokens_pre', 'pre'), ('tokens_alt', 'alt'), ('tokens_cur', 'cur')]
+    flat, lens = [], []
+    for field, key in fields:
+        field_flat, field_lens = _flatten_column([sentence[field] for sentence in sentences], max_len[key])
+        flat.extend(field_flat)
+        lens.append(field_lens)
+
+    # Every distinct token of the split is resolved once, including the case fallbacks...
+    codes, uniques = pd.factorize(np.asarray(flat, dtype=object))
+    unique_ids = np.fromiter((_resolve_word(word, word2id) for word in uniques), dtype=np.int32, count=len(uniques))
+    ids = unique_ids[codes]
+    start = 0
+    for (field, _), field_lens in zip(fields, lens):
+        end = start + int(field_lens.sum())
+        _scatter_ids(columns[field], ids[start:end], field_lens)
+        start = end
+    columns['id'][:] = np.fromiter((sentence['eid'] for sentence in sentences), dtype=np.int32, count=total)
+    columns['length'][:] = lens[0]
+    # Segment starts use the untruncated segment lengths, tokens is always pre + alt + cur...
+    pre_lens = np.fromiter((len(sentence['tokens_pre']) for sentence in sentences), dtype=np.int64, count=total)
+    alt_lens = np.fromiter((len(sentence['tokens_alt']) for sentence in sentences), dtype=np.int64, count=total)
+    columns['seg_start'][:, 0] = 0
+    columns['seg_start'][:, 1] = pre_lens
+    columns['seg_start'][:, 2] = pre_lens + alt_lens
+    columns['cau_label'][:] = np.fromiter((sentence['cau_label'] for sentence in sentences), dtype=np.int32,
+                                          count=total)
+    close_records(out_dir, columns)
     print('Build {} instances of features in total'.format(total))
     meta['total'] = total
     return meta
 
 
 def run_prepare(config):
-    #For Train...
-    train_examples, train_corpus, train_seg, train_labels = preprocess_train(config.raw_dir, config.train_file,
-                                                                             'train', config.build)
-    transfer_examples1 = preprocess_transfer(config.raw_dir, config.transfer_file1, 'transfer')
-    transfer_examples2 = preprocess_transfer(config.raw_dir, config.transfer_file2, 'transfer')
-    # For test...
-    valid_examples, valid_corpus, valid_seg, valid_labels = preprocess_test(config.raw_dir, config.valid_file,
-                                                                            'valid', config.build)
-    test_examples, test_corpus, test_seg, test_labels = preprocess_test(config.raw_dir, config.test_file,
-                                                                        'test', config.build)
+    token_cache = TokenCache(config.token_cache_file) if config.token_cache_file else None
+    manifest = StageManifest(config.stage_file, config.force_prepare)
+    # name, raw file, record dir, meta file, annotation file of every split...
+    splits = [('transfer1', config.transfer_file1, config.transfer_record_dir1, config.transfer_meta1, None),
+              ('transfer2', config.transfer_file2, config.transfer_record_dir2, config.transfer_meta2, None),
+              ('train', config.train_file, config.train_record_dir, config.train_meta, config.train_annotation),
+              ('valid', config.valid_file, config.valid_record_dir, config.valid_meta, None),
+              ('test', config.test_file, config.test_record_dir, config.test_meta, config.test_annotation)]
+    raw_fp = dict((name, hash_file(os.path.join(config.raw_dir, file_name))) for name, file_name, _, _, _ in splits)
+    examples = {}
 
     if config.build:
         # types = ['train', 'valid', 'test']
@@ -500,38 +557,61 @@ def run_prepare(config):
         # segs = [train_seg, valid_seg, test_seg]
         # for t, s, l in zip(types, segs, labels):
         # gen_annotation(s, config.max_len, os.path.join(config.processed_dir, t + '_annotations.txt'), l, t)
-        save(config.corpus_file, train_corpus, 'corpus')
-        corpus_dict = build_dict(config.corpus_file)
-        token_emb_mat, token2id, id2token = get_embedding('word', corpus_dict, config.w2v_file, config.n_emb)
-        save(config.token_emb_file, token_emb_mat, message='embeddings')
-        save(config.token2id_file, token2id, message='token to index')
-        save(config.id2token_file, id2token, message='index to token')
-    else:
-        with open(config.token2id_file, 'r') as fh:
-            token2id = json.load(fh)
-
-    transfer_meta1 = build_features(transfer_examples1, 'transfer', config.max_len, config.transfer_record_file1,
-                                    token2id)
-    save(config.transfer_meta1, transfer_meta1, message='transfer meta')
-    del transfer_examples1
-
-    transfer_meta2 = build_features(transfer_examples2, 'transfer', config.max_len, config.transfer_record_file2,
-                                    token2id)
-    save(config.transfer_meta2, transfer_meta2, message='transfer meta')
-    del transfer_examples2
-#Train meta...
-    train_meta = build_features(train_examples, 'train', config.max_len, config.train_record_file, token2id,
-                                config.train_annotation)
-    save(config.train_meta, train_meta, message='train meta')
-    del train_examples, train_corpus
-#Valid meta...
-    valid_meta = build_features(valid_examples, 'valid', config.max_len, config.valid_record_file, token2id)
-    save(config.valid_meta, valid_meta, message='valid meta')
-    del valid_examples, valid_corpus
-# Test meta...
-    test_meta = build_features(test_examples, 'test', config.max_len, config.test_record_file, token2id,
-                               config.test_annotation)
-    save(config.test_meta, test_meta, message='test meta')
-    del test_examples, test_corpus
-
+        # Dictionary stage, the corpus only depends on the train file and the tokenizer...
+        dict_fp = fingerprint('dict', raw_fp['train'], TOKENIZER_VERSION)
+        if not manifest.is_fresh('dict', dict_fp, [config.corpus_file]):
+            manifest.invalidate('dict')
+            examples['train'], train_corpus, train_seg, train_labels = preprocess_train(config.raw_dir,
+                                                                                        config.train_file, 'train',
+                                                                                        True, config.num_workers,
+                                                                                        token_cache)
+            save(config.corpus_file, train_corpus, 'corpus')
+            del train_corpus
+            manifest.mark('dict', dict_fp)
+        # Embedding stage, setups that still have the legacy pickle keep working until it is converted...
+        w2v_file = resolve_vectors(config.w2v_file)
+        emb_fp = fingerprint('embedding', dict_fp, stat_file(stamp_file(w2v_file)), config.n_emb,
+                             config.min_count, config.max_vocab)
+        if not manifest.is_fresh('embedding', emb_fp, [config.token_emb_file, config.token2id_file,
+                                                       config.id2token_file, config.token_count_file]):
+            manifest.invalidate('embedding')
+            corpus_dict = build_dict(config.corpus_file, config.num_workers, config.min_count, config.max_vocab,
+                                     config.token_count_file)
+            token_emb_mat, token2id, id2token = get_embedding('word', corpus_dict, w2v_file, config.n_emb)
+            save(config.token_emb_file, token_emb_mat, message='embeddings')
+            save(config.token2id_file, token2id, message='token to index')
+            save(config.id2token_file, id2token, message='index to token')
+            del token_emb_mat, id2token
+            manifest.mark('embedding', emb_fp)
+
+    with open(config.token2id_file, 'r') as fh:
+        token2id = json.load(fh)
+    fh.close()
+    vocab_fp = hash_file(config.token2id_file)
+
+    # Feature stage of every split, only stale splits are tokenized and rebuilt. The records hold the tokens, so a
+    # new tokenizer rebuilds them like it rebuilds the corpus...
+    for name, file_name, record_dir, meta_file, annotation_file in splits:
+        feature_fp = fingerprint('features', raw_fp[name], config.max_len, vocab_fp, TOKENIZER_VERSION)
+        if manifest.is_fresh(name, feature_fp, [os.path.join(record_dir, HEADER_FILE), meta_file]):
+            continue
+        manifest.invalidate(name)
+        if name in examples:
+            split_examples = examples.pop(name)
+        elif name == 'train':
+            split_examples = preprocess_train(config.raw_dir, file_name, name, False, config.num_workers,
+                                              token_cache)[0]
+        elif name.startswith('transfer'):
+            split_examples = preprocess_transfer(config.raw_dir, file_name, 'transfer')
+        else:
+            split_examples = preprocess_test(config.raw_dir, file_name, name, False, config.num_workers,
+                                             token_cache)[0]
+        meta = build_features(split_examples, name, config.max_len, record_dir, token2id, annotation_file)
+        save(meta_file, meta, message='{} meta'.format(name))
+        del split_examples
+        manifest.mark(name, feature_fp)
+
+    if token_cache is not None:
+        token_cache.report()
+        token_cache.close()
     save(config.shape_meta, {'max_len': config.max_len}, message='shape meta')
@@ -0,0 +1,293 @@
+import os
+import multiprocessing
+import pickle as pkl
+import numpy as np
+import ujson as json
+from tqdm import tqdm
+
+# A store is a directory with the raw float32 matrix, the words in row order and a json header...
+STORE_VERSION = 1
+VECTOR_FILE = 'vectors.bin'
+VOCAB_FILE = 'vocab.txt'
+HEADER_FILE = 'header.json'
+# Text files are parsed in byte ranges of this size, at most num_workers ranges are held in memory at once...
+CONVERT_BLOCK = 1 << 26
+
+
+def is_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, HEADER_FILE))
+
+
+class StoreWriter(object):
+    """
+    Appends word vectors to a store directory block by block, so a converter never needs the whole table in memory.
+    The header is written last by close, which marks the store as complete.
+    """
+
+    def __init__(self, store_dir, dim):
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        header_path = os.path.join(store_dir, HEADER_FILE)
+        if os.path.exists(header_path):
+            os.remove(header_path)
+        self.store_dir = store_dir
+        self.dim = dim
+        self.count = 0
+        self.vector_fh = open(os.path.join(store_dir, VECTOR_FILE), 'wb')
+        self.vocab_fh = open(os.path.join(store_dir, VOCAB_FILE), 'w', encoding='utf8')
+
+    def add(self, words, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        assert vectors.shape == (len(words), self.dim)
+        self.vector_fh.write(vectors.tobytes())
+        self.vocab_fh.writelines([word + '\n' for word in words])
+        self.count += len(words)
+
+    def close(self, source=None):
+        self.vector_fh.close()
+        self.vocab_fh.close()
+        header = {'version': STORE_VERSION, 'count': self.count, 'dim': self.dim, 'dtype': 'float32',
+                  'source': source}
+        with open(os.path.join(self.store_dir, HEADER_FILE), 'w') as fh:
+            json.dump(header, fh)
+        fh.close()
+        print('Saved {} vectors of size {} to {}'.format(self.count, self.dim, self.store_dir))
+        return header
+
+
+class VectorStore(object):
+    """
+    Read side of a store. The matrix is a read-only memory map, gather only reads the rows of the words asked for.
+    """
+
+    def __init__(self, store_dir):
+        if not is_store(store_dir):
+            raise IOError('No vector store found in {}, please convert the pretrained vectors with '
+                          'python -m preprocess.vector_store SRC DST first'.format(store_dir))
+        with open(os.path.join(store_dir, HEADER_FILE), 'r') as fh:
+            header = json.load(fh)
+        fh.close()
+        if header['version'] != STORE_VERSION:
+            raise IOError('Vector store {} has version {}, expected {}'.format(store_dir, header['version'],
+                                                                               STORE_VERSION))
+        self.store_dir = store_dir
+        self.count = header['count']
+        self.dim = header['dim']
+        self.vectors = np.memmap(os.path.join(store_dir, VECTOR_FILE), dtype=np.float32, mode='r',
+                                 shape=(self.count, self.dim))
+
+    def lookup(self, tokens):
+        """
+        Streams the vocabulary once and returns a dict from every wanted token to its row, the first row wins
+        when a source file repeats a word.
+        """
+        rows = {}
+        with open(os.path.join(self.store_dir, VOCAB_FILE), 'r', encoding='utf8', newline='\n') as fh:
+            for row, line in enumerate(fh):
+                word = line[:-1]
+                if word in tokens and word not in rows:
+                    rows[word] = row
+        fh.close()
+        return rows
+
+    def gather(self, tokens):
+        """
+        Returns the tokens found in the store and their vectors as a float32 matrix in the same order.
+        """
+        rows = self.lookup(tokens)
+        found = sorted(rows, key=rows.get)
+        # Ascending rows keep the reads from the memory map sequential...
+        return found, np.array(self.vectors[[rows[word] for word in found]], dtype=np.float32)
+
+
+def resolve_vectors(emb_file):
+    """
+    Returns the pretrained vectors to read for emb_file, the store itself or the legacy pickle next to it
+    (wiki.en.pkl for wiki.en.store) when the store has not been converted yet.
+    """
+    if os.path.exists(emb_file):
+        return emb_file
+    legacy_file = os.path.splitext(emb_file)[0] + '.pkl'
+    if os.path.exists(legacy_file):
+        return legacy_file
+    raise IOError('Neither the vector store {} nor the pickle {} exists, please convert the pretrained vectors with '
+                  'python -m preprocess.vector_store SRC {}'.format(emb_file, legacy_file, emb_file))
+
+
+def load_vectors(emb_file, tokens):
+    """
+    Pretrained vectors of the given tokens from either a store directory or a legacy pickled dict.
+    """
+    if os.path.isdir(emb_file):
+        return VectorStore(emb_file).gather(tokens)
+    # Raw text and binary releases are never unpickled, they go through convert first...
+    if os.path.splitext(emb_file)[1] != '.pkl':
+        raise IOError('{} is neither a vector store nor a pickle, please convert it with '
+                      'python -m preprocess.vector_store {} DST first'.format(emb_file, emb_file))
+    with open(emb_file, 'rb') as fin:
+        trained_embeddings = pkl.load(fin)
+    fin.close()
+    found = [token for token in tokens if token in trained_embeddings]
+    vectors = np.array([trained_embeddings[token] for token in found], dtype=np.float32)
+    return found, vectors
+
+
+def stamp_file(emb_file):
+    """
+    The file whose identity stands for the pretrained vectors, the header of a store is rewritten on every convert.
+    """
+    return os.path.join(emb_file, HEADER_FILE) if os.path.isdir(emb_file) else emb_file
+
+
+def convert_pickle(src, dst, block=100000):
+    """
+    Converts a pickled {word: vector} dict (wiki.en.pkl, glove.840B.pkl, fastText.pkl) into a store.
+    """
+    with open(src, 'rb') as fin:
+        trained_embeddings = pkl.load(fin)
+    fin.close()
+    words = [word for word in trained_embeddings if '\n' not in word]
+    writer = StoreWriter(dst, len(trained_embeddings[words[0]]))
+    for i in range(0, len(words), block):
+        chunk = words[i:i + block]
+        writer.add(chunk, np.stack([trained_embeddings[word] for word in chunk]))
+    return writer.close(source=os.path.abspath(src))
+
+
+def _read_header(src):
+    """
+    Returns (dim, offset of the first vector line). word2vec and fastText text files start with a "count dim"
+    line, GloVe files start with a vector straight away.
+    """
+    with open(src, 'rb') as fh:
+        first = fh.readline()
+    fh.close()
+    parts = first.rstrip().split(b' ')
+    if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
+        return int(parts[1]), len(first)
+    return len(parts) - 1, 0
+
+
+def _split_ranges(src, start, block):
+    # Byte ranges that each end on a line break, found by seeking instead of reading the whole file...
+    size = os.path.getsize(src)
+    ranges = []
+    with open(src, 'rb') as fh:
+        while start < size:
+            fh.seek(min(start + block, size))
+            fh.readline()
+            end = min(fh.tell(), size)
+            ranges.append((start, end))
+            start = end
+    fh.close()
+    return ranges
+
+
+def _parse_range(args):
+    src, start, end, dim = args
+    with open(src, 'rb') as fh:
+        fh.seek(start)
+        data = fh.read(end - start)
+    fh.close()
+    words, values, skipped = [], [], 0
+    for line in data.split(b'\n'):
+        parts = line.rstrip().split(b' ')
+        # GloVe 840B has a few words containing spaces, the vector is always the last dim fields...
+        if len(parts) <= dim:
+            skipped += 1 if len(line.strip()) > 0 else 0
+            continue
+        words.append(b' '.join(parts[:-dim]).decode('utf8', errors='replace'))
+        values.append(b' '.join(parts[-dim:]))
+    vectors = np.fromstring(b' '.join(values), dtype=np.float32, sep=' ').reshape(len(words), dim)
+    return words, vectors, skipped
+
+
+def convert_text(src, dst, num_workers=4, block=CONVERT_BLOCK):
+    """
+    Streams a GloVe, word2vec or fastText text file (with or without the count header) into a store in one pass.
+    Byte ranges are parsed in parallel and written back in file order, so memory stays bounded by num_workers blocks.
+    """
+    dim, start = _read_header(src)
+    ranges = _split_ranges(src, start, block)
+    writer = StoreWriter(dst, dim)
+    skipped = 0
+    pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
+    with tqdm(total=os.path.getsize(src) - start, unit='B', unit_scale=True, desc='Converting') as bar:
+        for i in range(0, len(ranges), max(1, num_workers)):
+            wave = [(src, s, e, dim) for s, e in ranges[i:i + max(1, num_workers)]]
+            results = pool.map(_parse_range, wave) if pool is not None else [_parse_range(w) for w in wave]
+            for (words, vectors, n_skipped), (_, s, e, _) in zip(results, wave):
+                writer.add(words, vectors)
+                skipped += n_skipped
+                bar.update(e - s)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if skipped > 0:
+        print('Skipped {} malformed lines'.format(skipped))
+    return writer.close(source=os.path.abspath(src))
+
+
+def convert_binary(src, dst, block=100000):
+    """
+    Streams a word2vec binary file (GoogleNews-vectors-negative300.bin) into a store, block rows at a time.
+    """
+    with open(src, 'rb') as fh:
+        count, dim = [int(x) for x in fh.readline().split()]
+        writer = StoreWriter(dst, dim)
+        row_bytes = 4 * dim
+        with tqdm(total=count, desc='Converting') as bar:
+            while writer.count < count:
+                words = []
+                vectors = np.empty([min(block, count - writer.count), dim], dtype=np.float32)
+                for i in range(len(vectors)):
+                    word = []
+                    ch = fh.read(1)
+                    while ch != b' ':
+                        if ch != b'\n':
+                            word.append(ch)
+                        ch = fh.read(1)
+                    words.append(b''.join(word).decode('utf8', errors='replace'))
+                    vectors[i] = np.frombuffer(fh.read(row_bytes), dtype=np.float32)
+                writer.add(words, vectors)
+                bar.update(len(words))
+    fh.close()
+    return writer.close(source=os.path.abspath(src))
+
+
+def convert_fasttext(src, dst, block=100000):
+    """
+    Converts a facebook fastText .bin model (cc.en.300.bin) through gensim, which has to load the model first.
+    The .vec text release of the same vectors converts faster and in bounded memory with convert_text.
+    """
+    from gensim.models import fasttext
+    model = fasttext.load_facebook_vectors(src)
+    words = model.index2word if hasattr(model, 'index2word') else model.index_to_key
+    writer = StoreWriter(dst, model.vector_size)
+    for i in range(0, len(words), block):
+        writer.add(words[i:i + block], model.vectors[i:i + block])
+    return writer.close(source=os.path.abspath(src))
+
+
+def convert(src, dst, fmt=None, num_workers=4):
+    """
+    Converts pretrained vectors into a store, fmt is one of pickle, text, binary, fasttext and is guessed from
+    the file extension when omitted.
+    """
+    if fmt is None:
+        ext = os.path.splitext(src)[1]
+        fmt = {'.pkl': 'pickle', '.bin': 'binary'}.get(ext, 'text')
+    if fmt == 'pickle':
+        return convert_pickle(src, dst)
+    elif fmt == 'text':
+        return convert_text(src, dst, num_workers)
+    elif fmt == 'binary':
+        return convert_binary(src, dst)
+    elif fmt == 'fasttext':
+        return convert_fasttext(src, dst)
+    raise ValueError('Unknown vector format {}'.format(fmt))
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(convert)
@@ -0,0 +1,89 @@
+import copy
+import time
+import torch
+from torch import nn
+from modules.torch_transformer import Encoder, LayerNorm
+from modules.torch_attention import Multihead_Attention, FeedForward, layer_normalization
+
+# Run from the project root: python -m tmp.layernorm_benchmark
+# TB encoder blocks at 128 tokens and the Hierarchical attention block over the bi-GRU output (2 * n_hidden)...
+n_emb, n_head, max_len, n_hidden = 300, 4, 128, 64
+
+
+class ReferenceNorm(nn.Module):
+    # The former mean / unbiased std normalization, kept here as the reference...
+    def __init__(self, gamma, beta, eps):
+        super(ReferenceNorm, self).__init__()
+        self.gamma, self.beta, self.eps = gamma, beta, eps
+
+    def forward(self, x):
+        mean = x.mean(-1, keepdim=True)
+        std = x.std(-1, keepdim=True)
+        return self.gamma * (x - mean) / (std + self.eps) + self.beta
+
+
+def with_reference_norms(block):
+    block = copy.deepcopy(block)
+    for name, module in list(block.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, LayerNorm):
+                setattr(module, child_name, ReferenceNorm(child.a_2, child.b_2, child.eps))
+            elif isinstance(child, layer_normalization):
+                setattr(module, child_name, ReferenceNorm(child.gamma, child.beta, child.epsilon))
+    return block
+
+
+def timeit(fn, repeat=20):
+    for _ in range(3):
+        fn()
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - start) / repeat * 1000
+
+
+def compare(name, block, x, run):
+    reference = with_reference_norms(block)
+    with torch.no_grad():
+        diff = (run(block, x) - run(reference, x)).abs().max().item()
+        old_ms = timeit(lambda: run(reference, x))
+        new_ms = timeit(lambda: run(block, x))
+    print('{:<14s} forward   former {:7.2f} ms  fused {:7.2f} ms  speedup {:.2f}x  max diff {:.2e}'.format(
+        name, old_ms, new_ms, old_ms / new_ms, diff))
+    old_ms = timeit(lambda: run(reference, x).sum().backward())
+    new_ms = timeit(lambda: run(block, x).sum().backward())
+    print('{:<14s} backward  former {:7.2f} ms  fused {:7.2f} ms  speedup {:.2f}x'.format(
+        name, old_ms, new_ms, old_ms / new_ms))
+
+
+def tolerance(batch_size=32, device='cpu', stds=(1., 0.1, 0.01, 0.001)):
+    # The fused form differs from the former one by a relative eps / std, small variance rows drift the most...
+    for eps in [1e-6, 1e-8]:
+        norm = nn.Sequential(LayerNorm(n_emb, eps)).to(device)
+        reference = with_reference_norms(norm)
+        for std in stds:
+            x = torch.randn(batch_size, max_len, n_emb, device=device) * std + 3 * std
+            with torch.no_grad():
+                diff = (norm(x) - reference(x)).abs().max().item()
+            print('eps {:.0e}  std {:.0e}  max diff {:.2e}'.format(eps, std, diff))
+
+
+def run(batch_size=32, device='cpu'):
+    torch.manual_seed(0)
+    x = torch.randn(batch_size, max_len, n_emb, device=device)
+    mask = torch.ones(batch_size, 1, max_len, dtype=torch.bool, device=device)
+    encoder = Encoder(n_head, 1, n_emb, 0.).to(device).eval()
+    compare('TB block', encoder, x, lambda block, x: block(x, mask))
+
+    y = torch.randn(batch_size, max_len, 2 * n_hidden, device=device)
+    block = nn.Sequential(Multihead_Attention(2 * n_hidden, n_head, 0.),
+                          FeedForward(2 * n_hidden, [8 * n_hidden, 2 * n_hidden])).to(device).eval()
+    compare('Hierarchical', block, y, lambda block, x: block(x))
+
+    norm = nn.Sequential(LayerNorm(n_emb)).to(device)
+    compare('LayerNorm', norm, x, lambda block, x: block(x))
+    tolerance(batch_size, device)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,86 @@
+import time
+import torch
+from torch import nn
+from modules.torch_relation import relation_pairs
+
+# Run from the project root: python -m tmp.relation_benchmark
+# The decomposed head is opt-in (--decomposed_relation), the concat head stays the default of every model...
+# Shapes of the CRN head with the default config, n_filter=50 and 3 kernels per segment, n_hidden=64...
+n_filter, n_kernels, n_hidden = 50, 3, 64
+n_object, n_linear = n_kernels * n_filter, 4 * n_hidden
+
+
+def concat_pairs(g_fc, y_pre, y_alt, y_cur, y_state):
+    # The previous CRN head, kept here as the reference...
+    batch_size = y_pre.size(0)
+    pre_cur = torch.cat((y_pre, y_cur), dim=1)
+    cur_pre = torch.cat((y_cur, y_pre), dim=1)
+    pre_alt = torch.cat((y_pre, y_alt), dim=1)
+    alt_cur = torch.cat((y_alt, y_cur), dim=1)
+    y_composed = torch.stack([pre_cur, cur_pre, pre_alt, alt_cur], dim=1)
+    y_state = torch.unsqueeze(y_state, 1)
+    y_state = y_state.repeat(1, 4, 1)
+    y_pair = torch.cat([y_composed, y_state], 2)
+    y_pair = y_pair.view(batch_size * 4, 2 * n_object + 2 * n_hidden)
+    y_pair = g_fc(y_pair)
+    return y_pair.view(batch_size, 4, n_linear)
+
+
+def saved_kb(fn, module):
+    # Sums the activations autograd keeps for backward in training, each storage once and without the weights...
+    params = set(p.untyped_storage().data_ptr() for p in module.parameters())
+    sizes = {}
+
+    def pack(tensor):
+        ptr = tensor.untyped_storage().data_ptr()
+        if ptr not in params:
+            sizes[ptr] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return sum(sizes.values()) / 1024.
+
+
+def timeit(fn, repeat=200):
+    for _ in range(10):
+        fn()
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - start) / repeat * 1000
+
+
+def run(batch_sizes=(32, 64, 256), device='cpu'):
+    g_fc = nn.Sequential(nn.Linear(2 * n_object + 2 * n_hidden, n_linear),
+                         nn.ReLU(),
+                         nn.Dropout(0.2),
+                         nn.Linear(n_linear, n_linear),
+                         nn.ReLU()).to(device).eval()
+    for batch_size in batch_sizes:
+        y_pre, y_alt, y_cur = [torch.randn(batch_size, n_object, device=device) for _ in range(3)]
+        y_state = torch.randn(batch_size, 2 * n_hidden, device=device)
+        with torch.no_grad():
+            old = concat_pairs(g_fc, y_pre, y_alt, y_cur, y_state)
+            new = relation_pairs(g_fc, [y_pre, y_alt, y_cur], y_state)
+            old_ms = timeit(lambda: concat_pairs(g_fc, y_pre, y_alt, y_cur, y_state))
+            new_ms = timeit(lambda: relation_pairs(g_fc, [y_pre, y_alt, y_cur], y_state))
+        print('batch {:4d}  concat {:.3f} ms  decomposed {:.3f} ms  speedup {:.2f}x  max diff {:.2e}'.format(
+            batch_size, old_ms, new_ms, old_ms / new_ms, (old - new).abs().max().item()))
+        # Forward and backward, the gradient flows back into the objects as it does in training...
+        for y in [y_pre, y_alt, y_cur, y_state]:
+            y.requires_grad_(True)
+        old_ms = timeit(lambda: concat_pairs(g_fc, y_pre, y_alt, y_cur, y_state).sum().backward())
+        new_ms = timeit(lambda: relation_pairs(g_fc, [y_pre, y_alt, y_cur], y_state).sum().backward())
+        print('batch {:4d}  backward  concat {:.3f} ms  decomposed {:.3f} ms  speedup {:.2f}x'.format(
+            batch_size, old_ms, new_ms, old_ms / new_ms))
+        g_fc.train()
+        old_kb = saved_kb(lambda: concat_pairs(g_fc, y_pre, y_alt, y_cur, y_state), g_fc)
+        new_kb = saved_kb(lambda: relation_pairs(g_fc, [y_pre, y_alt, y_cur], y_state), g_fc)
+        g_fc.eval()
+        print('batch {:4d}  saved for backward  concat {:.0f} KB  decomposed {:.0f} KB'.format(
+            batch_size, old_kb, new_kb))
+
+
+if __name__ == '__main__':
+    run()
@@ -2,23 +2,18 @@ import os
 import time
 import argparse
 import logging
-import random
+import multiprocessing
 import ujson as json
 import pickle as pkl
 import numpy as np
 import torch
 import torch.optim as optim
-from pytorch_transfor import WarmupCosineSchedule
+from pytorch_transformers import WarmupCosineSchedule
 from preprocess.torch_preprocess import run_prepare
 import models
-import models.torch_TextCNN
-import models.torch_DPCNN
-import models.tencent_DPCNN
-import models.torch_K-CNN
-import models.torch_MCNN
-
-from utils.torch_util import get_batch, evaluate_batch, case_batch, FocalLoss, draw_att, draw_curve, save_loss, \
-    save_metrics
+from utils.record_util import load_records
+from utils.torch_util import BatchProvider, bucket_batches, epoch_rng, epoch_order, prefetch_batches, dynamic_pad_enabled, schedule_steps, evaluate_batch, case_batch, FocalLoss, autocast, grad_scaler, cast_frozen_embeddings, draw_att, draw_curve, save_loss, \
+    save_metrics, shared_embeddings, share_frozen_embeddings, init_logger
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = '3'
 
@@ -31,6 +26,8 @@ def parse_args():
                         help='create the directories, prepare the vocabulary and embeddings')
     parser.add_argument('--build', action='store_true',
                         help='whether to build word dict and embeddings')
+    parser.add_argument('--force_prepare', action='store_true',
+                        help='rebuild every prepare stage even if its inputs are unchanged')
     parser.add_argument('--train', action='store_true',
                         help='train the model')
     parser.add_argument('--evaluate', action='store_true',
@@ -43,6 +40,12 @@ def parse_args():
                         help='specify gpu device')
     parser.add_argument('--seed', type=int, default=23333,
                         help='random seed (default: 23333)')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='number of processes used to tokenize the raw data in --prepare')
+    parser.add_argument('--parallel', type=int, default=1,
+                        help='number of --multi turns trained at the same time in worker processes')
+    parser.add_argument('--worker_threads', type=int, default=0,
+                        help='torch threads of every --parallel worker, 0 splits the cpus between them')
     # Train Setting....
     train_settings = parser.add_argument_group('train settings')
     train_settings.add_argument('--disable_cuda', action='store_true',
@@ -63,6 +66,8 @@ def parse_args():
                                 help='train batch size')
     train_settings.add_argument('--batch_eval', type=int, default=64,
                                 help='dev batch size')
+    train_settings.add_argument('--accumulate_steps', type=int, default=1,
+                                help='micro-batches of batch_train accumulated per optimizer step')
     train_settings.add_argument('--epochs', type=int, default=10,
                                 help='train epochs')
     train_settings.add_argument('--optim', default='Adam',
@@ -73,28 +78,48 @@ def parse_args():
                                 help='period to save batch loss')
     train_settings.add_argument('--num_threads', type=int, default=8,
                                 help='Number of threads in input pipeline')
+    train_settings.add_argument('--pin_memory', action='store_true', default=True,
+                                help='assemble batches in pinned memory when training on gpu (default)')
+    train_settings.add_argument('--no_pin_memory', dest='pin_memory', action='store_false',
+                                help='assemble batches in pageable memory')
+    train_settings.add_argument('--dynamic_pad', action='store_true',
+                                help='trim every batch to its longest sample instead of max_len and mask the padding out of '
+                                     'the max pools')
+    train_settings.add_argument('--bucket_pool', type=int, default=50,
+                                help='number of batches sorted by length together, 0 disables bucketing')
+    train_settings.add_argument('--precision', default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                                help='compute dtype of the forward pass, bf16/fp16 run under autocast')
     # Model Setting...
     model_settings = parser.add_argument_group('model settings')
     model_settings.add_argument('--max_len', type=dict, default={'full': 128, 'pre': 64, 'alt': 8, 'cur': 64},
                                 help='max length of sequence')
     model_settings.add_argument('--w2v_type', type=str, default='wiki',
                                 help='type of the embeddings')
+    model_settings.add_argument('--min_count', type=int, default=1,
+                                help='drop corpus tokens seen fewer times from the vocabulary')
+    model_settings.add_argument('--max_vocab', type=int, default=None,
+                                help='keep at most this many of the most frequent tokens')
+    model_settings.add_argument('--shared_embedding', action='store_true',
+                                help='embed the full sentence once and cut the pre/alt/cur segments out of it')
+    model_settings.add_argument('--decomposed_relation', action='store_true',
+                                help='compute the relation pairs from per-object projections instead of concatenating '
+                                     'them')
     model_settings.add_argument('--n_emb', type=int, default=300,
                                 help='size of the embeddings')
-    #model_settings.add_argument('--n_hidden', type=int, default=64,
-    #                            help='size of LSTM hidden units')
-    #model_settings.add_argument('--n_layer', type=int, default=2,
-    #                            help='num of layers')
+    model_settings.add_argument('--n_hidden', type=int, default=64,
+                                help='size of LSTM hidden units')
+    model_settings.add_argument('--n_layer', type=int, default=2,
+                                help='num of layers')
     model_settings.add_argument('--is_fc', type=bool, default=True,
                                 help='whether to use focal loss')
     #model_settings.add_argument('--is_atten', type=bool, default=False,
     #                            help='whether to use self attention')
     #model_settings.add_argument('--is_gated', type=bool, default=False,
     #                            help='whether to use gated conv')
-    #model_settings.add_argument('--n_block', type=int, default=4,
-    #                            help='attention block size (default: 2)')
-    #model_settings.add_argument('--n_head', type=int, default=4,
-    #                            help='attention head size (default: 2)')
+    model_settings.add_argument('--n_block', type=int, default=4,
+                                help='attention block size (default: 4)')
+    model_settings.add_argument('--n_head', type=int, default=4,
+                                help='attention head size (default: 4)')
     model_settings.add_argument('--is_pos', type=bool, default=False,
                                 help='whether to use position embedding')
     model_settings.add_argument('--is_sinusoid', type=bool, default=True,
@@ -138,6 +163,8 @@ def parse_args():
                                help='the dir to store raw data')
     path_settings.add_argument('--processed_dir', default='data/processed_data/torch',
                                help='the dir to store prepared data')
+    path_settings.add_argument('--token_cache_file', default='data/processed_data/token_cache.sqlite',
+                               help='sqlite file caching tokenized segments, empty to disable')
     path_settings.add_argument('--outputs_dir', default='outputs/',
                                help='the dir for outputs')
     path_settings.add_argument('--model_dir', default='models/',
@@ -157,71 +184,88 @@ def parse_args():
 
 # args = parse_args()....
 
-def train_one_epoch(model, optimizer, scheduler, train_num, train_file, args, logger):
+def train_one_epoch(model, optimizer, scheduler, scaler, provider, batches, args, logger):
     model.train()
-    train_loss = []
-    n_batch_loss = 0  # weight is in rang of 0.2 to 0.8.
+    # weight is in rang of 0.2 to 0.8, the criterion is built once per epoch instead of once per batch...
     weight = torch.from_numpy(np.array([0.2, 0.8], dtype=np.float32)).to(args.device)
+    if args.is_fc:
+        criterion = FocalLoss(gamma=4, alpha=0.75)
+    else:
+        criterion = torch.nn.CrossEntropyLoss(weight)
+    # Losses are summed on the device and only read back at period boundaries and at the end of the epoch, every
+    # .item() would wait for the queued kernels and stall the launches behind it...
+    epoch_loss = torch.zeros((), device=args.device)
+    n_batch_loss = torch.zeros((), device=args.device)
+    start_t = period_t = time.time()
 
     # enumerate function is used to display both index and value together..
-    for batch_idx, batch in enumerate(range(0, train_num, args.batch_train)):
-        start_idx = batch
-        end_idx = start_idx + args.batch_train
+    trim = dynamic_pad_enabled(model, args.dynamic_pad)
+    n_batches = len(batches)
+    accumulate_steps = max(1, args.accumulate_steps)
+    optimizer.zero_grad()
+    for batch_idx, batch in enumerate(prefetch_batches(provider, batches, trim, args.num_threads)):
         # sentences, cau_labels, seq_lens = get_batch(train_file[start_idx:end_idx], args.device)...used in other Modls
-        tokens, tokens_pre, tokens_alt, tokens_cur, cau_labels, seq_lens, _ = get_batch(train_file[start_idx:end_idx],
-                                                                                        args.device)
-        # Make gradient to zero...
-        optimizer.zero_grad()
-        outputs = model(tokens, tokens_pre, tokens_alt, tokens_cur, seq_lens)
+        tokens, tokens_pre, tokens_alt, tokens_cur, cau_labels, seq_lens, seg_starts, _ = batch
+        # With --precision bf16/fp16 the forward runs under autocast, the loss is taken on float32 logits...
+        with autocast(args.device, args.precision):
+            outputs = model(tokens, tokens_pre, tokens_alt, tokens_cur, seq_lens, seg_starts)
         # outputs = model(sentences)...this is used for sentence input types
         # loss = compute_loss(logits=outputs, target=labels, length=seq_lens)
         # is_fc = focal loss...FocalLoss is imported fun...
-
-        if args.is_fc:
-            criterion = FocalLoss(gamma=4, alpha=0.75)
-        else:
-            criterion = torch.nn.CrossEntropyLoss(weight)
-        loss = criterion(outputs, cau_labels)
+        loss = criterion(outputs.float(), cau_labels)
 
         # params = model.state_dict()
         # l2_reg = torch.autograd.Variable(torch.FloatTensor(1), requires_grad=True).cuda()
         # l2_reg = l2_reg + params['linear.weight'].norm(2) + params['linear.bias'].norm(2)
         # loss += l2_reg * args.weight_decay
 
-        # BackPropagation step...
-        loss.backward()
-        # we use 'args' extension with those features which is mentioned in the above ''def parse_args()''
-        if args.clip > 0:
-            # Gradient clipping, input is (NN parameter, maximum gradient norm, norm type=2), general default is L2 norm
-            torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
-        # Update the weights...w =:w-alpha*grad
-        optimizer.step()
-        scheduler.step()
-        n_batch_loss += loss.item()
+        # BackPropagation step, the gradients of accumulate_steps micro-batches add up to the mean over their window,
+        # the last window of the epoch may be shorter. The scaler only scales the fp16 loss...
+        window_start = batch_idx - batch_idx % accumulate_steps
+        window = min(accumulate_steps, n_batches - window_start)
+        scaler.scale(loss / window).backward()
+        # Clip, step and schedule once per window, on the accumulated gradient...
+        if batch_idx + 1 == window_start + window:
+            # we use 'args' extension with those features which is mentioned in the above ''def parse_args()''
+            if args.clip > 0:
+                # Gradient clipping, input is (NN parameter, maximum gradient norm, norm type=2), general default is L2 norm
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+            # Update the weights...w =:w-alpha*grad, skipped by the scaler when fp16 gradients overflowed
+            scaler.step(optimizer)
+            scaler.update()
+            scheduler.step()
+            # Make gradient to zero...
+            optimizer.zero_grad()
+        n_batch_loss += loss.detach()
         bidx = batch_idx + 1
 
-        # The result of below command is, Causality - INFO - AvgLoss batch [1 1000] - 0.00609822194994922...
+        # The result of below command is, Causality - INFO - AvgLoss batch [1 1000] - 0.00609822194994922 - 52.31 batches/s...
         if bidx % args.period == 0:
-            logger.info('AvgLoss batch [{} {}] - {}'.format(bidx - args.period + 1, bidx, n_batch_loss / args.period))
-            n_batch_loss = 0  # (1000 - 1000 + 1)..
-        train_loss.append(loss.item())
-
-    avg_train_loss = np.mean(train_loss)
+            epoch_loss += n_batch_loss
+            period_loss = n_batch_loss.item() / args.period
+            now = time.time()
+            logger.info('AvgLoss batch [{} {}] - {} - {:.2f} batches/s'.format(bidx - args.period + 1, bidx, period_loss,
+                                                                              args.period / (now - period_t)))
+            period_t = now
+            n_batch_loss.zero_()  # (1000 - 1000 + 1)..
+
+    avg_train_loss = (epoch_loss + n_batch_loss).item() / max(1, len(batches))
+    logger.info('Trained {} batches in {:.1f} s - {:.2f} batches/s'.format(len(batches), time.time() - start_t,
+                                                                         len(batches) / (time.time() - start_t)))
     return avg_train_loss
 
-def train(args, file_paths):
-    logger = logging.getLogger('Causality')
+def load_train_data(file_paths, logger, token_embeddings=None):
+    """
+    The records are read-only memmaps, every process that opens them shares their pages through the page cache.
+    """
     # Loading train_file... and show me this result = Causality - INFO - Loading train file...
     logger.info('Loading train file...')
-    with open(file_paths.train_record_file, 'rb') as fh:
-        train_file = pkl.load(fh)
-    fh.close()
+    train_file = load_records(file_paths.train_record_dir)
 
     # Loading valid_file...and show me this result = Causality - INFO - Loading valid file...
     logger.info('Loading valid file...')
-    with open(file_paths.valid_record_file, 'rb') as fh:
-        valid_file = pkl.load(fh)
-    fh.close()
+    valid_file = load_records(file_paths.valid_record_dir)
 
     # Loading train meta...
     logger.info('Loading train meta...')
@@ -232,140 +276,192 @@ def train(args, file_paths):
     valid_meta = load_json(file_paths.valid_meta)
 
     # Loading token emb....
-    logger.info('Loading token embeddings...')
-    with open(file_paths.token_emb_file, 'rb') as fh:
-        token_embeddings = pkl.load(fh)
-    fh.close()
+    if token_embeddings is None:
+        logger.info('Loading token embeddings...')
+        with open(file_paths.token_emb_file, 'rb') as fh:
+            token_embeddings = pkl.load(fh)
+        fh.close()
 
     # These two command show Num of train data 100744 and valid data 488..
     # train_meta = {"total": 100744}
     # valid_meta = {"total": 488}
+    return train_file, valid_file, train_meta['total'], valid_meta['total'], token_embeddings
 
-    train_num = train_meta['total']
-    valid_num = valid_meta['total']
 
-    logger.info('Loading shape meta...')
-    logger.info('Num train data {} valid data {}'.format(train_num, valid_num))
+def train_turn(i, args, data, logger):
+    """
+    Trains and validates one turn of --multi. Returns its record row and best valid sum, the best model of the turn
+    is saved to turn_{i}_model.bin.
+    """
+    train_file, valid_file, train_num, valid_num, token_embeddings = data
+    train_provider = BatchProvider(train_file, args.device, args.pin_memory, args.num_threads + 2)
+    train_lengths = np.asarray(train_file['length'])
+
+    # Every turn seeds its own initialization, so a turn gives the same model in a worker or in sequence, turn 1
+    # keeps the plain seed...
+    torch.manual_seed(args.seed + i - 1)
+    logger.info('Initialize the model...')
 
+    # This command run the whole models, if you change args.model attribute to specific model such as args.MCKN,
+    # then it will run MCKN Model, the same for others models...
+    # model = --model', default='MCKN', help='the model name')...
+
+    model = getattr(models, args.model)(token_embeddings, args, logger).to(device=args.device)
+    share_frozen_embeddings(model, token_embeddings)
+    cast_frozen_embeddings(model, args.precision)
+
+    # model = TKC(token_embeddings, args.max_len['full'], args.n_class,
+    #                       n_channel=[args.n_filter] * args.n_level, n_kernel=args.n_kernel, n_block=args.n_block,
+    #                       n_head=args.n_head, dropout=dropout, logger=logger). to(device=args.device)
+    # model = TextCNN(token_embeddings, args.max_len, args.n_class, args.n_kernels, args.n_filter, args.is_pos,
+    #                 args.is_sinusoid, args.dropout, logger).to(device=args.device)
+
+    # model = TextCNNDeep(token_embeddings, args.max_len, args.n_class, args.n_kernels, args.n_filter,
+    #                     args.dropout, logger).to(device=args.device)
+
+    # model = DPCNN(token_embeddings, args, logger).to(device=args.device)
+
+    lr = args.lr
+    optimizer = getattr(optim, args.optim)(model.parameters(), lr=lr, weight_decay=args.weight_decay)
+    # scheduler = optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.9)
+    # scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'max', 0.5, patience=args.patience, verbose=True)
+
+    # This command is used for Turn1, Turn2, and Turn3 each of fifteen epochs.....
+    scheduler = WarmupCosineSchedule(optimizer, args.warmup, schedule_steps(train_num, args.batch_train, args.epochs,
+                                                                            args.accumulate_steps))
+    scaler = grad_scaler(args.device, args.precision)
+    logger.info('Turn {}'.format(i))
+
+    # Initialize all 8 matrices to zero, by using np.zeros(8) = 0.0 0.0 0.0 0.0 0.0 0.0 0.0 0.0
+
+    max_acc, max_p, max_r, max_f, max_roc, max_prc, max_sum, max_epoch = np.zeros(8)
+    FALSE, ROC, PRC = {}, {}, {}
+    train_loss, valid_loss = [], []
+
+    # Train the model by using for loop for 15 epochs...
+    for ep in range(1, args.epochs + 1):
+        logger.info('Training the model for epoch {}'.format(ep))
+        # The records are read-only memmaps, so the epoch order is a seeded permutation of row indices...
+        rng = epoch_rng(args.seed, ep, i)
+        order = epoch_order(train_num, rng)
+        batches = bucket_batches(order, train_lengths, args.batch_train, args.bucket_pool, rng)
+        avg_loss = train_one_epoch(model, optimizer, scheduler, scaler, train_provider, batches, args, logger)
+
+        train_loss.append(avg_loss)
+
+        # Below command give this result....Epoch 1 AvgLoss 0.0038728943148974054
+        logger.info('Epoch {} AvgLoss {}'.format(ep, avg_loss))
+
+        # Evaluating the model on valid_file...
+        logger.info('Evaluating the model for epoch {}'.format(ep))
+        # evaluate_batch is imported fun...
+        eval_metrics, fpr, tpr, precision, recall = evaluate_batch(model, valid_num, args.batch_eval, valid_file,
+                                                                   args.device, args.is_fc, 'valid', logger, args.dynamic_pad,
+                                                                   args.precision)
+        valid_loss.append(eval_metrics['loss'])
+
+        # Print all validation values, such as, Loss, Acc, Pre, Recall, F1, AUROC, and AUCPRC...
+        logger.info('Valid Loss - {}'.format(eval_metrics['loss']))
+        logger.info('Valid Acc - {}'.format(eval_metrics['acc']))
+        logger.info('Valid Precision - {}'.format(eval_metrics['precision']))
+        logger.info('Valid Recall - {}'.format(eval_metrics['recall']))
+        logger.info('Valid F1 - {}'.format(eval_metrics['f1']))
+        logger.info('Valid AUCROC - {}'.format(eval_metrics['auc_roc']))
+        logger.info('Valid AUCPRC - {}'.format(eval_metrics['auc_prc']))
+        valid_sum = eval_metrics['auc_roc'] + eval_metrics['auc_prc'] + eval_metrics['f1']
+
+        # if valid_sum is greater than max_sum then use th below command.....
+        if valid_sum > max_sum:
+            max_acc = eval_metrics['acc']
+            max_p = eval_metrics['precision']
+            max_r = eval_metrics['recall']
+            max_f = eval_metrics['f1']
+            max_roc = eval_metrics['auc_roc']
+            max_prc = eval_metrics['auc_prc']
+            max_sum = valid_sum
+            max_epoch = ep
+            FALSE = {'FP': eval_metrics['fp'], 'FN': eval_metrics['fn']}
+            # Lists, the numpy curves of sklearn are not json serializable...
+            ROC = {'FPR': fpr.tolist(), 'TPR': tpr.tolist()}
+            PRC = {'PRECISION': precision.tolist(), 'RECALL': recall.tolist()}
+
+            # torch.save(model, os.path.join(args.model_dir, 'model.pth'))
+            # The best turn is picked once all turns are done, see train...
+            torch.save(model.state_dict(), os.path.join(args.model_dir, 'turn_{}_model.bin'.format(i)))
+
+    # Using logger to print the maximum values...
+    logger.info('Max Acc - {}'.format(max_acc))
+    logger.info('Max Precision - {}'.format(max_p))
+    logger.info('Max Recall - {}'.format(max_r))
+    logger.info('Max F1 - {}'.format(max_f))
+    logger.info('Max ROC - {}'.format(max_roc))
+    logger.info('Max PRC - {}'.format(max_prc))
+    logger.info('Max Epoch - {}'.format(max_epoch))
+    logger.info('Max Sum - {}'.format(max_sum))
+
+    # Where is this result_dir ? and where is pics_dir....? These are stored in output folder of GUP Machine...
+    outputs = {'FALSE': FALSE, 'ROC': ROC, 'PRC': PRC, 'train_loss': train_loss, 'valid_loss': valid_loss}
+    return [max_acc, max_p, max_r, max_f, max_roc, max_prc, max_epoch], max_sum, outputs
+
+
+def _train_worker(task):
+    # Runs one turn in a pool process, which starts without the parent's logger and thread settings...
+    i, args, file_paths = task
+    torch.set_num_threads(args.worker_threads)
+    logger = init_logger(args.log_path, 'Turn {}'.format(i))
+    data = load_train_data(file_paths, logger, shared_embeddings(file_paths.token_emb_file))
+    return train_turn(i, args, data, logger)
+
+
+def train(args, file_paths):
+    logger = logging.getLogger('Causality')
     # Dropout code.....
     # Here this 'args' mean a parser object....emb dropout and layer dropout...
     args.dropout = {'emb': args.emb_dropout, 'layer': args.layer_dropout}
 
     # args.multi denote the number of models...by default is 7 models,, default=3, help='times for experiment'...
-    records = np.zeros((args.multi, 7), dtype=np.float)
-    best_sum = -1
+    # With --parallel above 1 the turns run at the same time in worker processes of worker_threads threads each,
+    # the records are reopened as memmaps by every worker and the embeddings are shared through a .npy memmap...
+    parallel = min(max(1, args.parallel), args.multi)
+    if parallel > 1:
+        if args.worker_threads <= 0:
+            args.worker_threads = max(1, (os.cpu_count() or 1) // parallel)
+        shared_embeddings(file_paths.token_emb_file)
+        logger.info('Running {} turns in {} workers of {} threads'.format(args.multi, parallel, args.worker_threads))
+        worker_paths = argparse.Namespace(**vars(file_paths))
+        pool = multiprocessing.get_context('spawn').Pool(parallel, maxtasksperchild=1)
+        results = pool.map(_train_worker, [(i, args, worker_paths) for i in range(1, args.multi + 1)], chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        data = load_train_data(file_paths, logger)
+        logger.info('Num train data {} valid data {}'.format(data[2], data[3]))
+        results = [train_turn(i, args, data, logger) for i in range(1, args.multi + 1)]
 
-    # i is used to show 3 turns for each epoch...
+    records = np.array([record for record, _, _ in results], dtype=np.float64)
 
-    for i in range(1, args.multi + 1):
-        logger.info('Initialize the model...')
+    # Every turn used to overwrite these files, so only the outputs of the last turn are written...
+    outputs = results[-1][2]
+    dump_json(os.path.join(args.result_dir, 'FALSE_valid.json'), outputs['FALSE'])
+    dump_json(os.path.join(args.result_dir, 'ROC_valid.json'), outputs['ROC'])
+    dump_json(os.path.join(args.result_dir, 'PRC_valid.json'), outputs['PRC'])
 
-    # This command run the whole models, if you change args.model attribute to specific model such as args.MCKN,
-        # then it will run MCKN Model, the same for others models...
-        # model = --model', default='MCKN', help='the model name')...
-
-        model = getattr(models, args.model)(token_embeddings, args, logger).to(device=args.device)
-
-        # model = TKC(token_embeddings, args.max_len['full'], args.n_class,
-        #                       n_channel=[args.n_filter] * args.n_level, n_kernel=args.n_kernel, n_block=args.n_block,
-        #                       n_head=args.n_head, dropout=dropout, logger=logger). to(device=args.device)
-        # model = TextCNN(token_embeddings, args.max_len, args.n_class, args.n_kernels, args.n_filter, args.is_pos,
-        #                 args.is_sinusoid, args.dropout, logger).to(device=args.device)
-
-        # model = TextCNNDeep(token_embeddings, args.max_len, args.n_class, args.n_kernels, args.n_filter,
-        #                     args.dropout, logger).to(device=args.device)
-
-        # model = DPCNN(token_embeddings, args, logger).to(device=args.device)
-
-        lr = args.lr
-        optimizer = getattr(optim, args.optim)(model.parameters(), lr=lr, weight_decay=args.weight_decay)
-        # scheduler = optim.lr_scheduler.ExponentialLR(optimizer, gamma=0.9)
-        # scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'max', 0.5, patience=args.patience, verbose=True)
-
-        # This command is used for Turn1, Turn2, and Turn3 each of fifteen epochs.....
-        scheduler = WarmupCosineSchedule(optimizer, args.warmup, (train_num // args.batch_train + 1) * args.epochs)
-        logger.info('Turn {}'.format(i))
-
-        # Initialize all 8 matrices to zero, by using np.zeros(8) = 0.0 0.0 0.0 0.0 0.0 0.0 0.0 0.0
-
-        max_acc, max_p, max_r, max_f, max_roc, max_prc, max_sum, max_epoch = np.zeros(8)
-        FALSE, ROC, PRC = {}, {}, {}
-        train_loss, valid_loss = [], []
-
-        is_best = False
-
-        # Train the model by using for loop for 15 epochs...
-        for ep in range(1, args.epochs + 1):
-            logger.info('Training the model for epoch {}'.format(ep))
-            avg_loss = train_one_epoch(model, optimizer, scheduler, train_num, train_file, args, logger)
-
-            train_loss.append(avg_loss)
-
-            # Below command give this result....Epoch 1 AvgLoss 0.0038728943148974054
-            logger.info('Epoch {} AvgLoss {}'.format(ep, avg_loss))
-
-            # Evaluating the model on valid_file...
-            logger.info('Evaluating the model for epoch {}'.format(ep))
-            # evaluate_batch is imported fun...
-            eval_metrics, fpr, tpr, precision, recall = evaluate_batch(model, valid_num, args.batch_eval, valid_file,
-                                                                       args.device, args.is_fc, 'valid', logger)
-            valid_loss.append(eval_metrics['loss'])
-
-            # Print all validation values, such as, Loss, Acc, Pre, Recall, F1, AUROC, and AUCPRC...
-            logger.info('Valid Loss - {}'.format(eval_metrics['loss']))
-            logger.info('Valid Acc - {}'.format(eval_metrics['acc']))
-            logger.info('Valid Precision - {}'.format(eval_metrics['precision']))
-            logger.info('Valid Recall - {}'.format(eval_metrics['recall']))
-            logger.info('Valid F1 - {}'.format(eval_metrics['f1']))
-            logger.info('Valid AUCROC - {}'.format(eval_metrics['auc_roc']))
-            logger.info('Valid AUCPRC - {}'.format(eval_metrics['auc_prc']))
-            valid_sum = eval_metrics['auc_roc'] + eval_metrics['auc_prc'] + eval_metrics['f1']
-
-            # if valid_sum is greater than max_sum then use th below command.....
-            if valid_sum > max_sum:
-                max_acc = eval_metrics['acc']
-                max_p = eval_metrics['precision']
-                max_r = eval_metrics['recall']
-                max_f = eval_metrics['f1']
-                max_roc = eval_metrics['auc_roc']
-                max_prc = eval_metrics['auc_prc']
-                max_sum = valid_sum
-                max_epoch = ep
-                FALSE = {'FP': eval_metrics['fp'], 'FN': eval_metrics['fn']}
-                ROC = {'FPR': fpr, 'TPR': tpr}
-                PRC = {'PRECISION': precision, 'RECALL': recall}
-
-                # torch.save(model, os.path.join(args.model_dir, 'model.pth'))
-                if max_sum > best_sum:
-                    best_sum = max_sum
-                    is_best = True
-                    ts = time.strftime("%Y-%m-%d-%H%M%S", time.localtime())
-                    torch.save(model.state_dict(), os.path.join(args.model_dir, 'best_model.bin'))
-
-            random.shuffle(train_file)
-
-        # Using logger to print the maximum values...
-        logger.info('Max Acc - {}'.format(max_acc))
-        logger.info('Max Precision - {}'.format(max_p))
-        logger.info('Max Recall - {}'.format(max_r))
-        logger.info('Max F1 - {}'.format(max_f))
-        logger.info('Max ROC - {}'.format(max_roc))
-        logger.info('Max PRC - {}'.format(max_prc))
-        logger.info('Max Epoch - {}'.format(max_epoch))
-        logger.info('Max Sum - {}'.format(max_sum))
-
-        # Where is this result_dir ? and where is pics_dir....? These are stored in output folder of GUP Machine...
-        dump_json(os.path.join(args.result_dir, 'FALSE_valid.json'), FALSE)
-        dump_json(os.path.join(args.result_dir, 'ROC_valid.json'), ROC)
-        dump_json(os.path.join(args.result_dir, 'PRC_valid.json'), PRC)
-
-        # Save_loss, this is imported fun...
-        save_loss(train_loss, valid_loss, args.result_dir)
-
-        # Draw_curve, this is imported fun
-        draw_curve(ROC['FPR'], ROC['TPR'], PRC['PRECISION'], PRC['RECALL'], args.pics_dir)
-
-        records[i - 1] = [max_acc, max_p, max_r, max_f, max_roc, max_prc, max_epoch]
+    # Save_loss, this is imported fun...
+    save_loss(outputs['train_loss'], outputs['valid_loss'], args.result_dir)
+
+    # Draw_curve, this is imported fun
+    draw_curve(outputs['ROC']['FPR'], outputs['ROC']['TPR'], outputs['PRC']['PRECISION'], outputs['PRC']['RECALL'],
+               args.pics_dir)
+
+    # The best turn over all turns becomes best_model.bin...
+    best = int(np.argmax([max_sum for _, max_sum, _ in results])) + 1
+    for i in range(1, args.multi + 1):
+        turn_model = os.path.join(args.model_dir, 'turn_{}_model.bin'.format(i))
+        if i == best and os.path.exists(turn_model):
+            os.replace(turn_model, os.path.join(args.model_dir, 'best_model.bin'))
+        elif os.path.exists(turn_model):
+            os.remove(turn_model)
+    logger.info('Best turn {} - Sum {}'.format(best, results[best - 1][1]))
 
     # Save_metrics is imported fun...
     save_metrics(records, args.result_dir)
@@ -376,15 +472,11 @@ def train(args, file_paths):
 def evaluate(args, file_paths):
     logger = logging.getLogger('Causality')
     logger.info('Loading valid file...')  # if you don't mentioned the logger path it is displayed on the consul...
-    with open(file_paths.valid_record_file, 'rb') as fh:
-        valid_file = pkl.load(fh)
-    fh.close()
+    valid_file = load_records(file_paths.valid_record_dir)
 
     # Loading test file as well...
     logger.info('Loading test file...')
-    with open(file_paths.test_record_file, 'rb') as fh:
-        test_file = pkl.load(fh)
-    fh.close()
+    test_file = load_records(file_paths.test_record_dir)
 
     # Lodaing valid_meta....
     logger.info('Loading valid meta...')
@@ -421,10 +513,12 @@ def evaluate(args, file_paths):
 
     # Define the model....the below command is used to Load the best_model.bin among all model for testing...
     model = getattr(models, args.model)(token_embeddings, args, logger).to(device=args.device)
+    cast_frozen_embeddings(model, args.precision)
     model.load_state_dict(torch.load(os.path.join(args.model_dir, 'best_model.bin')))
 
     eval_metrics, fpr, tpr, precision, recall = evaluate_batch(model, test_num, args.batch_eval, test_file,
-                                                               args.device, args.is_fc, 'eval', logger)
+                                                               args.device, args.is_fc, 'eval', logger, args.dynamic_pad,
+                                                               args.precision)
     logger.info('Eval Loss - {}'.format(eval_metrics['loss']))
     logger.info('Eval Acc - {}'.format(eval_metrics['acc']))
     logger.info('Eval Precision - {}'.format(eval_metrics['precision']))
@@ -455,9 +549,7 @@ def evaluate(args, file_paths):
 def case(args, file_path):
     logger = logging.getLogger('Causality')
     logger.info('Loading test file...')
-    with open(file_path.test_record_file, 'rb') as fh:
-        test_file = pkl.load(fh)
-    fh.close()
+    test_file = load_records(file_path.test_record_dir)
 
     # Loading test_meta....
     logger.info('Loading test meta...')
@@ -483,10 +575,11 @@ def case(args, file_path):
 
     # Define the model...
     model = getattr(models, args.model)(token_embeddings, args, logger).to(device=args.device)
+    cast_frozen_embeddings(model, args.precision)
     model.load_state_dict(torch.load(os.path.join(args.model_dir, '2019-09-03-164417_model.bin')))
 
     # Predication_Scores...case_batch is imported fun...
-    pred_scores = case_batch(model, test_num, args.batch_eval, test_file, args.device)
+    pred_scores = case_batch(model, test_num, args.batch_eval, test_file, args.device, args.precision)
     print(pred_scores)
 
     # Model choice...and draw_attributes...
@@ -515,21 +608,7 @@ def run():
     Prepares and runs the whole system...
     """
     args = parse_args()
-    logger = logging.getLogger('Causality')
-    logger.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-    # Whether to store logs...
-    if args.log_path:
-        file_handler = logging.FileHandler(args.log_path)
-        file_handler.setLevel(logging.INFO)
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
-    else:
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)
-        console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
+    logger = init_logger(args.log_path)
 
     logger.info('Running with args : {}'.format(args))
     os.environ['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
@@ -558,12 +637,12 @@ def run():
     class FilePaths(object):
         def __init__(self, w2v_type):
 
-            # Run record file...
-            self.train_record_file = os.path.join(args.processed_dir, 'train.pkl')
-            self.valid_record_file = os.path.join(args.processed_dir, 'valid.pkl')
-            self.test_record_file = os.path.join(args.processed_dir, 'test.pkl')
-            self.transfer_record_file1 = os.path.join(args.processed_dir, 'transfer1.pkl')
-            self.transfer_record_file2 = os.path.join(args.processed_dir, 'transfer2.pkl')
+            # Run record dirs, one memmap per field...
+            self.train_record_dir = os.path.join(args.processed_dir, 'train_records')
+            self.valid_record_dir = os.path.join(args.processed_dir, 'valid_records')
+            self.test_record_dir = os.path.join(args.processed_dir, 'test_records')
+            self.transfer_record_dir1 = os.path.join(args.processed_dir, 'transfer_records1')
+            self.transfer_record_dir2 = os.path.join(args.processed_dir, 'transfer_records2')
 
             # Count files...
             self.train_meta = os.path.join(args.processed_dir, 'train_meta.json')
@@ -572,6 +651,7 @@ def run():
             self.transfer_meta1 = os.path.join(args.processed_dir, 'transfer_meta1.json')
             self.transfer_meta2 = os.path.join(args.processed_dir, 'transfer_meta2.json')
             self.shape_meta = os.path.join(args.processed_dir, 'shape_meta.json')
+            self.stage_file = os.path.join(args.processed_dir, 'prepare_stages.json')
 
             # Annotation files...
             self.train_annotation = os.path.join(args.processed_dir, 'train_annotations.txt')
@@ -582,19 +662,20 @@ def run():
             self.corpus_file = os.path.join(args.processed_dir, 'corpus.txt')
             self.token_emb_file = os.path.join(args.processed_dir, 'token_emb.pkl')
             self.token2id_file = os.path.join(args.processed_dir, 'token2id.json')
+            self.token_count_file = os.path.join(args.processed_dir, 'token_counts.json')
             self.id2token_file = os.path.join(args.processed_dir, 'id2token.json')
 
             # Where is these different word2V embedding files..except wiki...
             if w2v_type == 'wiki':
-                self.w2v_file = './data/processed_data/wiki.en.pkl'
+                self.w2v_file = './data/processed_data/wiki.en.store'
             elif w2v_type == 'google':
-                self.w2v_file = './data/processed_data/google.news.pkl'
+                self.w2v_file = './data/processed_data/google.news.store'
             elif w2v_type == 'glove6':
-                self.w2v_file = './data/processed_data/glove.6B.pkl'
+                self.w2v_file = './data/processed_data/glove.6B.store'
             elif w2v_type == 'glove840':
-                self.w2v_file = './data/processed_data/glove.840B.pkl'
+                self.w2v_file = './data/processed_data/glove.840B.store'
             elif w2v_type == 'fastText':
-                self.w2v_file = './data/processed_data/fastText.pkl'
+                self.w2v_file = './data/processed_data/fastText.store'
 
     file_paths = FilePaths(args.w2v_type)
 
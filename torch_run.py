@@ -1,6 +1,6 @@
 import os
+import time
 import logging
-import random
 import pickle as pkl
 import numpy as np
 import torch
@@ -9,61 +9,75 @@ from pytorch_transformers import WarmupCosineSchedule
 from config import opt
 from preprocess.torch_preprocess import run_prepare
 import models
-from utils.torch_util import get_batch, evaluate_batch, case_batch, FocalLoss, draw_att, draw_curve, load_json, dump_json, save_loss
+from utils.record_util import load_records
+from utils.torch_util import BatchProvider, bucket_batches, epoch_rng, epoch_order, prefetch_batches, dynamic_pad_enabled, schedule_steps, evaluate_batch, case_batch, FocalLoss, autocast, grad_scaler, cast_frozen_embeddings, draw_att, draw_curve, load_json, dump_json, save_loss, init_logger
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = '3'
 
 
-def train_one_epoch(model, optimizer, scheduler, train_num, train_file, args, logger):
+def train_one_epoch(model, optimizer, scheduler, scaler, provider, batches, args, logger):
     model.train()
-    train_loss = []
-    n_batch_loss = 0
     weight = torch.from_numpy(np.array([0.2, 0.8], dtype=np.float32)).to(args.device)
-    for batch_idx, batch in enumerate(range(0, train_num, args.batch_train)):
-        start_idx = batch
-        end_idx = start_idx + args.batch_train
-        tokens, tokens_pre, tokens_alt, tokens_cur, cau_labels, seq_lens, _ = get_batch(train_file[start_idx:end_idx],
-                                                                                        args.device)
-
-        optimizer.zero_grad()
-        outputs = model(tokens, tokens_pre, tokens_alt, tokens_cur, seq_lens)
-        if args.is_fc:
-            criterion = FocalLoss(gamma=4, alpha=0.75)
-        else:
-            criterion = torch.nn.CrossEntropyLoss(weight)
-        loss = criterion(outputs, cau_labels)
+    if args.is_fc:
+        criterion = FocalLoss(gamma=4, alpha=0.75)
+    else:
+        criterion = torch.nn.CrossEntropyLoss(weight)
+    # Losses stay on the device, .item() is only called at period boundaries and at the end of the epoch...
+    epoch_loss = torch.zeros((), device=args.device)
+    n_batch_loss = torch.zeros((), device=args.device)
+    start_t = period_t = time.time()
+    trim = dynamic_pad_enabled(model, args.dynamic_pad)
+    n_batches = len(batches)
+    accumulate_steps = max(1, args.accumulate_steps)
+    optimizer.zero_grad()
+    for batch_idx, batch in enumerate(prefetch_batches(provider, batches, trim, args.num_threads)):
+        tokens, tokens_pre, tokens_alt, tokens_cur, cau_labels, seq_lens, seg_starts, _ = batch
+
+        with autocast(args.device, args.precision):
+            outputs = model(tokens, tokens_pre, tokens_alt, tokens_cur, seq_lens, seg_starts)
+        loss = criterion(outputs.float(), cau_labels)
         # params = model.state_dict()
         # l2_reg = torch.autograd.Variable(torch.FloatTensor(1), requires_grad=True).cuda()
         # l2_reg = l2_reg + params['linear.weight'].norm(2) + params['linear.bias'].norm(2)
         # loss += l2_reg * args.weight_decay
     #Backpropogation...
-        loss.backward()
-        if args.clip > 0:
-            # 梯度裁剪，输入是(NN参数，最大梯度范数，范数类型=2)，一般默认为L2范数
-            torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
-        optimizer.step()
-        scheduler.step()
-        n_batch_loss += loss.item()
+        # Gradients of accumulate_steps micro-batches add up to the mean over their window, the last window of the
+        # epoch may be shorter. The scaler only scales the fp16 loss, it passes everything through in fp32 and bf16...
+        window_start = batch_idx - batch_idx % accumulate_steps
+        window = min(accumulate_steps, n_batches - window_start)
+        scaler.scale(loss / window).backward()
+        if batch_idx + 1 == window_start + window:
+            if args.clip > 0:
+                # 梯度裁剪，输入是(NN参数，最大梯度范数，范数类型=2)，一般默认为L2范数
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+            scaler.step(optimizer)
+            scaler.update()
+            scheduler.step()
+            optimizer.zero_grad()
+        n_batch_loss += loss.detach()
         bidx = batch_idx + 1
         if bidx % args.period == 0:
-            logger.info('AvgLoss batch [{} {}] - {}'.format(bidx - args.period + 1, bidx, n_batch_loss / args.period))
-            n_batch_loss = 0
-        train_loss.append(loss.item())
-
-    avg_train_loss = np.mean(train_loss)
+            epoch_loss += n_batch_loss
+            period_loss = n_batch_loss.item() / args.period
+            now = time.time()
+            logger.info('AvgLoss batch [{} {}] - {} - {:.2f} batches/s'.format(bidx - args.period + 1, bidx, period_loss,
+                                                                              args.period / (now - period_t)))
+            period_t = now
+            n_batch_loss.zero_()
+
+    avg_train_loss = (epoch_loss + n_batch_loss).item() / max(1, len(batches))
+    logger.info('Trained {} batches in {:.1f} s - {:.2f} batches/s'.format(len(batches), time.time() - start_t,
+                                                                         len(batches) / (time.time() - start_t)))
     return avg_train_loss
 
 
 def train(args):
     logger = logging.getLogger('Causality')
     logger.info('Loading train file...')
-    with open(args.train_record_file, 'rb') as fh:
-        train_file = pkl.load(fh)
-    fh.close()
+    train_file = load_records(args.train_record_dir)
     logger.info('Loading valid file...')
-    with open(args.valid_record_file, 'rb') as fh:
-        valid_file = pkl.load(fh)
-    fh.close()
+    valid_file = load_records(args.valid_record_dir)
     logger.info('Loading train meta...')
     train_meta = load_json(args.train_meta)
     logger.info('Loading valid meta...')
@@ -74,6 +88,8 @@ def train(args):
     fh.close()
     train_num = train_meta['total']
     valid_num = valid_meta['total']
+    train_provider = BatchProvider(train_file, args.device, args.pin_memory, args.num_threads + 2)
+    train_lengths = np.asarray(train_file['length'])
 
     logger.info('Loading shape meta...')
     logger.info('Num train data {} valid data {}'.format(train_num, valid_num))
@@ -81,23 +97,31 @@ def train(args):
     args.dropout = {'emb': args.emb_dropout, 'layer': args.layer_dropout}
     logger.info('Initialize the model...')
     model = getattr(models, args.model)(token_embeddings, args, logger).to(device=args.device)
+    cast_frozen_embeddings(model, args.precision)
     lr = args.lr
     optimizer = getattr(optim, args.optim)(model.parameters(), lr=lr, weight_decay=args.weight_decay)
     # scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'max', 0.5, patience=args.patience, verbose=True)
-    scheduler = WarmupCosineSchedule(optimizer, args.warmup, (train_num // args.batch_train + 1) * args.epochs)
+    scheduler = WarmupCosineSchedule(optimizer, args.warmup, schedule_steps(train_num, args.batch_train, args.epochs,
+                                                                            args.accumulate_steps))
+    scaler = grad_scaler(args.device, args.precision)
     # torch.backends.cudnn.benchmark = True
     max_acc, max_p, max_r, max_f, max_roc, max_prc, max_sum, max_epoch = np.zeros(8)
     FALSE, ROC, PRC = {}, {}, {}
     train_loss, valid_loss = [], []
     for ep in range(1, args.epochs + 1):
         logger.info('Training the model for epoch {}'.format(ep))
-        avg_loss = train_one_epoch(model, optimizer, scheduler, train_num, train_file, args, logger)
+        # The records are read-only memmaps, so the epoch order is a seeded permutation of row indices...
+        rng = epoch_rng(args.seed, ep, 0)
+        order = epoch_order(train_num, rng)
+        batches = bucket_batches(order, train_lengths, args.batch_train, args.bucket_pool, rng)
+        avg_loss = train_one_epoch(model, optimizer, scheduler, scaler, train_provider, batches, args, logger)
         train_loss.append(avg_loss)
         logger.info('Epoch {} AvgLoss {}'.format(ep, avg_loss))
 
         logger.info('Evaluating the model for epoch {}'.format(ep))
         eval_metrics, fpr, tpr, precision, recall = evaluate_batch(model, valid_num, args.batch_eval, valid_file,
-                                                                   args.device, args.is_fc, 'valid', logger)
+                                                                   args.device, args.is_fc, 'valid', logger, args.dynamic_pad,
+                                                                   args.precision)
         valid_loss.append(eval_metrics['loss'])
         logger.info('Valid Loss - {}'.format(eval_metrics['loss']))
         logger.info('Valid Acc - {}'.format(eval_metrics['acc']))
@@ -126,7 +150,6 @@ def train(args):
             torch.save(model.state_dict(), os.path.join(args.model_dir, 'model.bin'))
 
         # scheduler.step(metrics=eval_metrics['f1'])
-        random.shuffle(train_file)
 
     logger.info('Max Acc - {}'.format(max_acc))
     logger.info('Max Precision - {}'.format(max_p))
@@ -147,13 +170,9 @@ def train(args):
 def evaluate(args):
     logger = logging.getLogger('Causality')
     logger.info('Loading valid file...')
-    with open(args.valid_record_file, 'rb') as fh:
-        valid_file = pkl.load(fh)
-    fh.close()
+    valid_file = load_records(args.valid_record_dir)
     logger.info('Loading test file...')
-    with open(args.test_record_file, 'rb') as fh:
-        test_file = pkl.load(fh)
-    fh.close()
+    test_file = load_records(args.test_record_dir)
     logger.info('Loading valid meta...')
     valid_meta = load_json(args.valid_meta)
     logger.info('Loading test meta...')
@@ -172,10 +191,12 @@ def evaluate(args):
 
     args.dropout = {'emb': args.emb_dropout, 'layer': args.layer_dropout}
     model = getattr(models, args.model)(token_embeddings, args, logger).to(device=args.device)
+    cast_frozen_embeddings(model, args.precision)
     model.load_state_dict(torch.load(os.path.join(args.model_dir, 'model.bin')))
 
     eval_metrics, fpr, tpr, precision, recall = evaluate_batch(model, test_num, args.batch_eval, test_file,
-                                                               args.device, args.is_fc, 'eval', logger)
+                                                               args.device, args.is_fc, 'eval', logger, args.dynamic_pad,
+                                                               args.precision)
     logger.info('Eval Loss - {}'.format(eval_metrics['loss']))
     logger.info('Eval Acc - {}'.format(eval_metrics['acc']))
     logger.info('Eval Precision - {}'.format(eval_metrics['precision']))
@@ -201,9 +222,7 @@ def evaluate(args):
 def case(args):
     logger = logging.getLogger('Causality')
     logger.info('Loading test file...')
-    with open(args.test_record_file, 'rb') as fh:
-        test_file = pkl.load(fh)
-    fh.close()
+    test_file = load_records(args.test_record_dir)
     logger.info('Loading test meta...')
     test_meta = load_json(args.test_meta)
     logger.info('Loading id to token file...')
@@ -218,9 +237,10 @@ def case(args):
 
     args.dropout = {'emb': args.emb_dropout, 'layer': args.layer_dropout}
     model = getattr(models, args.model)(token_embeddings, args, logger).to(device=args.device)
+    cast_frozen_embeddings(model, args.precision)
     model.load_state_dict(torch.load(os.path.join(args.model_dir, 'model.bin')))
 
-    pred_scores = case_batch(model, test_num, args.batch_eval, test_file, args.device)
+    pred_scores = case_batch(model, test_num, args.batch_eval, test_file, args.device, args.precision)
     print(pred_scores)
 
     if args.model == 'MCDN' or args.model == 'TB':
@@ -234,20 +254,7 @@ def run(**kwargs):
     """
     opt._parse(kwargs)
 
-    logger = logging.getLogger('Causality')
-    logger.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    # 是否存储日志
-    if opt.log_path:
-        file_handler = logging.FileHandler(opt.log_path)
-        file_handler.setLevel(logging.INFO)
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
-    else:
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)
-        console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
+    logger = init_logger(opt.log_path)
     # logger.info('Running with args : {}'.format(opt))
     os.environ['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
     os.environ['CUDA_VISIBLE_DEVICES'] = opt.gpu
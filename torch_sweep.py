@@ -0,0 +1,261 @@
+import os
+import copy
+import time
+import logging
+import itertools
+import multiprocessing
+import numpy as np
+import pandas as pd
+import torch
+import torch.optim as optim
+from pytorch_transformers import WarmupCosineSchedule
+from config import opt
+import models
+from torch_run import train_one_epoch
+from utils.record_util import load_records
+from utils.torch_util import BatchProvider, bucket_batches, epoch_rng, epoch_order, schedule_steps, evaluate_batch, \
+    grad_scaler, cast_frozen_embeddings, share_frozen_embeddings, load_json, shared_embeddings, init_logger
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = '3'
+
+# These knobs select the processed data itself, which is loaded once and shared by all trials of a sweep...
+DATA_KEYS = ['task', 'max_len', 'w2v_type', 'min_count', 'max_vocab', 'n_emb', 'processed_dir', 'train_file',
+             'valid_file', 'test_file']
+# These are fixed for the whole process, the device is picked once for all trials...
+PROCESS_KEYS = ['gpu', 'disable_cuda', 'log_path', 'outputs_dir', 'model_dir', 'result_dir', 'pics_dir',
+                'summary_dir']
+METRIC_KEYS = ['acc', 'precision', 'recall', 'f1', 'auc_roc', 'auc_prc']
+
+# Data of the current process, loaded once by load_data and reused by every trial it runs...
+_worker = {}
+
+
+def load_space(space):
+    """
+    The search space is a dict, or a json file holding one, from a DefaultConfig field to either a list of values
+    or a range {"low": .., "high": .., "log": false}. Ranges are only sampled by the random and asha methods, int
+    bounds give int values on the linear and the log scale.
+    """
+    if isinstance(space, str):
+        space = load_json(space)
+    for key, spec in space.items():
+        if not hasattr(opt, key):
+            raise ValueError('DefaultConfig has no attribute {}'.format(key))
+        if key in DATA_KEYS:
+            raise ValueError('{} changes the processed data and cannot be swept, run one sweep per value'.format(key))
+        if key in PROCESS_KEYS:
+            raise ValueError('{} is set once for the whole sweep and cannot be swept'.format(key))
+        if isinstance(spec, dict) and not ('low' in spec and 'high' in spec):
+            raise ValueError('Range of {} needs low and high'.format(key))
+    return space
+
+
+def sample_value(spec, rng):
+    if not isinstance(spec, dict):
+        return spec[rng.randint(len(spec))]
+    low, high = spec['low'], spec['high']
+    is_int = isinstance(low, int) and isinstance(high, int)
+    if spec.get('log', False):
+        value = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+        # Rounding can step just outside the bounds, the int fields (n_filter, n_hidden...) build layer sizes...
+        return int(min(max(round(value), low), high)) if is_int else value
+    if is_int:
+        return int(rng.randint(low, high + 1))
+    return float(rng.uniform(low, high))
+
+
+def make_trials(space, method, n_trials, seed):
+    """
+    grid enumerates every combination of the listed values, random and asha draw n_trials samples.
+    """
+    keys = sorted(space)
+    if method == 'grid':
+        ranges = [key for key in keys if isinstance(space[key], dict)]
+        if ranges:
+            raise ValueError('grid needs a list of values for {}'.format(', '.join(ranges)))
+        return [dict(zip(keys, values)) for values in itertools.product(*[space[key] for key in keys])]
+    elif method in ['random', 'asha']:
+        rng = np.random.RandomState(seed)
+        return [{key: sample_value(space[key], rng) for key in keys} for _ in range(n_trials)]
+    raise ValueError('Unknown sweep method {}'.format(method))
+
+
+def asha_rungs(min_epochs, eta, epochs):
+    # Rungs at min_epochs * eta^k below the full budget, a trial reaching the last epoch is never stopped...
+    rungs = []
+    rung = max(1, min_epochs)
+    while rung < epochs:
+        rungs.append(rung)
+        rung *= eta
+    return rungs
+
+
+class AshaPruner(object):
+    """
+    Asynchronous successive halving. Every trial reports its best valid sum when it reaches a rung and is stopped
+    unless it is in the top 1 / eta of the trials that reached that rung so far, so no trial waits for the others.
+    The rung scores live in a manager dict shared by the worker processes.
+    """
+
+    def __init__(self, rungs, eta, manager):
+        self.rungs = rungs
+        self.eta = eta
+        self.scores = manager.dict({rung: [] for rung in rungs})
+        self.lock = manager.Lock()
+
+    def should_stop(self, epoch, score):
+        if epoch not in self.rungs:
+            return False
+        with self.lock:
+            recorded = self.scores[epoch] + [score]
+            self.scores[epoch] = recorded
+        return score < np.percentile(recorded, 100 * (1 - 1. / self.eta))
+
+
+def load_data(args):
+    """
+    Loads the records, metas and embeddings of the sweep once per process. The records are read-only memmaps and
+    the embeddings a copy-on-write memmap that the frozen embedding tables point at, so the workers share their
+    pages.
+    """
+    train_file = load_records(args.train_record_dir)
+    valid_file = load_records(args.valid_record_dir)
+    _worker['data'] = (train_file, valid_file, load_json(args.train_meta)['total'], load_json(args.valid_meta)['total'],
+                       shared_embeddings(args.token_emb_file))
+    _worker['lengths'] = np.asarray(train_file['length'])
+
+
+def init_worker(args, worker_threads):
+    torch.set_num_threads(worker_threads)
+    init_logger(args.log_path, 'Sweep worker {}'.format(os.getpid()))
+    load_data(args)
+
+
+def run_trial(task):
+    """
+    Trains one trial and validates it after every epoch. Returns its row of the results table, the metrics are
+    those of the epoch with the best valid sum, as in torch_run.train.
+    """
+    trial_id, args, pruner = task
+    train_file, valid_file, train_num, valid_num, token_embeddings = _worker['data']
+    # Per batch and per epoch lines of all trials would drown the sweep log, trials only log warnings...
+    logger = logging.getLogger('Causality.trial')
+    logger.setLevel(logging.WARNING)
+    start_t = time.time()
+
+    # Every trial starts from the same seed, so trials differ by their hyperparameters only...
+    torch.manual_seed(args.seed)
+    args.dropout = {'emb': args.emb_dropout, 'layer': args.layer_dropout}
+    model = getattr(models, args.model)(token_embeddings, args, logger).to(device=args.device)
+    share_frozen_embeddings(model, token_embeddings)
+    cast_frozen_embeddings(model, args.precision)
+    # Built per trial, pin_memory and num_threads may be swept...
+    train_provider = BatchProvider(train_file, args.device, args.pin_memory, args.num_threads + 2)
+    optimizer = getattr(optim, args.optim)(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    scheduler = WarmupCosineSchedule(optimizer, args.warmup, schedule_steps(train_num, args.batch_train, args.epochs,
+                                                                            args.accumulate_steps))
+    scaler = grad_scaler(args.device, args.precision)
+
+    best = dict((key, 0.) for key in METRIC_KEYS)
+    best.update({'sum': 0., 'epoch': 0})
+    status, ep = 'completed', 0
+    for ep in range(1, args.epochs + 1):
+        rng = epoch_rng(args.seed, ep, 0)
+        order = epoch_order(train_num, rng)
+        batches = bucket_batches(order, _worker['lengths'], args.batch_train, args.bucket_pool, rng)
+        train_one_epoch(model, optimizer, scheduler, scaler, train_provider, batches, args, logger)
+        eval_metrics = evaluate_batch(model, valid_num, args.batch_eval, valid_file, args.device, args.is_fc, 'valid',
+                                      logger, args.dynamic_pad, args.precision)[0]
+        valid_sum = eval_metrics['auc_roc'] + eval_metrics['auc_prc'] + eval_metrics['f1']
+        if valid_sum > best['sum']:
+            best.update((key, eval_metrics[key]) for key in METRIC_KEYS)
+            best.update({'sum': valid_sum, 'epoch': ep})
+        if pruner is not None and pruner.should_stop(ep, best['sum']):
+            status = 'pruned'
+            break
+
+    row = {'trial': trial_id, 'status': status, 'trained_epochs': ep, 'seconds': time.time() - start_t,
+           'sum': best['sum'], 'best_epoch': best['epoch']}
+    row.update(('valid_' + key, best[key]) for key in METRIC_KEYS)
+    return row
+
+
+def sweep(space, method='random', n_trials=10, n_workers=1, worker_threads=0, min_epochs=1, eta=3, **kwargs):
+    """
+    Runs a hyperparameter sweep of torch_run.train over DefaultConfig and writes one results table.
+    python torch_sweep.py sweep --space=sweep.json --method=asha --n_trials=30 --n_workers=4 --model=MCKN
+    Args:
+        space: search space, see load_space.
+        method: grid, random or asha (random samples pruned by asynchronous successive halving).
+        n_trials: number of samples of random and asha.
+        n_workers: number of trials trained at the same time, each in its own process.
+        worker_threads: torch threads of every worker, 0 splits the cpus between the workers.
+        min_epochs, eta: first asha rung and reduction factor, rungs sit at min_epochs * eta^k epochs.
+        kwargs: fixed DefaultConfig values shared by all trials, as for torch_run.run.
+    """
+    opt._parse(kwargs)
+    logger = init_logger(opt.log_path, 'Sweep')
+    os.environ['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
+    os.environ['CUDA_VISIBLE_DEVICES'] = opt.gpu
+    if torch.cuda.is_available() and not opt.disable_cuda:
+        opt.device = torch.device('cuda')
+    else:
+        opt.device = torch.device('cpu')
+
+    space = load_space(space)
+    trials = make_trials(space, method, n_trials, opt.seed)
+    tasks = []
+    manager = multiprocessing.get_context('spawn').Manager() if method == 'asha' else None
+    pruner = None
+    if manager is not None:
+        rungs = asha_rungs(min_epochs, eta, opt.epochs)
+        pruner = AshaPruner(rungs, eta, manager)
+        logger.info('ASHA rungs at epochs {} with eta {}'.format(rungs, eta))
+    for trial_id, params in enumerate(trials):
+        args = copy.copy(opt)
+        for key, value in params.items():
+            setattr(args, key, value)
+        tasks.append((trial_id, args, pruner))
+
+    # The embedding memmap is written once here, before any worker opens it...
+    shared_embeddings(opt.token_emb_file)
+    n_workers = min(max(1, n_workers), len(tasks))
+    if worker_threads <= 0:
+        worker_threads = max(1, (os.cpu_count() or 1) // n_workers)
+    logger.info('Running {} {} trials in {} workers of {} threads'.format(len(tasks), method, n_workers,
+                                                                         worker_threads))
+    rows = []
+    if n_workers > 1:
+        pool = multiprocessing.get_context('spawn').Pool(n_workers, init_worker, (opt, worker_threads))
+        results = pool.imap_unordered(run_trial, tasks)
+    else:
+        pool = None
+        load_data(opt)
+        results = map(run_trial, tasks)
+    for row in results:
+        row.update(trials[row['trial']])
+        rows.append(row)
+        logger.info('Trial {} {} after {} epochs - Sum {:.4f} - {}'.format(
+            row['trial'], row['status'], row['trained_epochs'], row['sum'], trials[row['trial']]))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if manager is not None:
+        manager.shutdown()
+
+    # One row per trial, best first...
+    columns = ['trial', 'status', 'trained_epochs', 'seconds'] + sorted(space) + ['sum', 'best_epoch'] + \
+              ['valid_' + key for key in METRIC_KEYS]
+    df = pd.DataFrame(rows, columns=columns).sort_values('sum', ascending=False)
+    ts = time.strftime("%Y-%m-%d-%H%M%S", time.localtime())
+    result_file = os.path.join(opt.result_dir, ts + '_sweep_{}.csv'.format(method))
+    df.to_csv(result_file, index=False)
+    best_trial = int(df.iloc[0]['trial'])
+    logger.info('Best trial {} - Sum {:.4f} - {}'.format(best_trial, df.iloc[0]['sum'], trials[best_trial]))
+    logger.info('Saved the sweep results to {}'.format(result_file))
+    return result_file
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire()
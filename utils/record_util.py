@@ -0,0 +1,74 @@
+import os
+import numpy as np
+import ujson as json
+
+# Every record directory holds one .npy file per field plus a small json header...
+RECORD_FIELDS = ['id', 'tokens', 'tokens_pre', 'tokens_alt', 'tokens_cur', 'length', 'cau_label', 'seg_start']
+RECORD_VERSION = 2
+HEADER_FILE = 'header.json'
+
+
+def _field_shapes(total, max_len):
+    return {'id': (total,),
+            'tokens': (total, max_len['full']),
+            'tokens_pre': (total, max_len['pre']),
+            'tokens_alt': (total, max_len['alt']),
+            'tokens_cur': (total, max_len['cur']),
+            'length': (total,),
+            'cau_label': (total,),
+            # Where the pre, alt and cur segments start inside tokens...
+            'seg_start': (total, 3)}
+
+
+def create_records(record_dir, total, max_len):
+    """
+    Allocates one zero-filled int32 memmap per field inside record_dir, so that build_features can fill
+    the columns in place without holding the whole split in memory.
+    """
+    if not os.path.exists(record_dir):
+        os.makedirs(record_dir)
+    # Remove a stale header first, a half written directory must never look complete...
+    header_path = os.path.join(record_dir, HEADER_FILE)
+    if os.path.exists(header_path):
+        os.remove(header_path)
+    columns = {}
+    for field, shape in _field_shapes(total, max_len).items():
+        columns[field] = np.lib.format.open_memmap(os.path.join(record_dir, field + '.npy'), mode='w+',
+                                                   dtype=np.int32, shape=shape)
+    return columns
+
+
+def close_records(record_dir, columns):
+    """
+    Flushes the memmaps returned by create_records and writes the header, which marks the directory as complete.
+    """
+    header = {'version': RECORD_VERSION, 'total': int(len(columns['id'])), 'fields': {}}
+    for field in RECORD_FIELDS:
+        columns[field].flush()
+        header['fields'][field] = {'dtype': str(columns[field].dtype), 'shape': list(columns[field].shape)}
+    with open(os.path.join(record_dir, HEADER_FILE), 'w') as fh:
+        json.dump(header, fh)
+    fh.close()
+    return header
+
+
+def load_records(record_dir, mmap_mode='r'):
+    """
+    Opens a record directory written by build_features. With the default mmap_mode the arrays are read-only
+    memory maps, so nothing is copied into RAM until a batch is sliced out of them.
+    """
+    header_path = os.path.join(record_dir, HEADER_FILE)
+    if not os.path.exists(header_path):
+        raise IOError('No complete records found in {}, please run --prepare first'.format(record_dir))
+    with open(header_path, 'r') as fh:
+        header = json.load(fh)
+    fh.close()
+    if header['version'] != RECORD_VERSION:
+        raise IOError('Records in {} have version {}, expected {}'.format(record_dir, header['version'],
+                                                                          RECORD_VERSION))
+    records = {}
+    for field in RECORD_FIELDS:
+        records[field] = np.load(os.path.join(record_dir, field + '.npy'), mmap_mode=mmap_mode)
+        if list(records[field].shape) != header['fields'][field]['shape']:
+            raise IOError('Field {} in {} does not match its header'.format(field, record_dir))
+    return records
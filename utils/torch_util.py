@@ -5,38 +5,247 @@ from torch.autograd import Variable
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, confusion_matrix, roc_curve, auc, precision_recall_curve
 import matplotlib.pyplot as plt
 import ujson as json
+import pickle as pkl
 import seaborn
 import os
 import time
+import logging
+import contextlib
 import pandas as pd
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 seaborn.set_context(context="talk")
 plt.switch_backend('agg')
 
 
-def get_batch(samples, device):
-    ids, tokens, tokens_pre, tokens_alt, tokens_cur, cau_labels, seq_lens = [], [], [], [], [], [], []
-  # if a sample is in samples, then append each sample[id,tokens,token_pre,token_alt,token_cur, cau_label, length]
-    for sample in samples:
-        ids.append(sample['id'])
-        tokens.append(sample['tokens'])
-        tokens_pre.append(sample['tokens_pre'])
-        tokens_alt.append(sample['tokens_alt'])
-        tokens_cur.append(sample['tokens_cur'])
-        cau_labels.append(sample['cau_label'])
-        seq_lens.append(sample['length'])
-
-    # Size and format of tokens....
-    tokens = np.asarray(tokens, dtype=np.int64)
-    tokens_pre = np.asarray(tokens_pre, dtype=np.int64)
-    tokens_alt = np.asarray(tokens_alt, dtype=np.int64)
-    tokens_cur = np.asarray(tokens_cur, dtype=np.int64)
-    cau_labels = np.asarray(cau_labels, dtype=np.int64)
-    seq_lens = np.asarray(seq_lens, dtype=np.int64)
-
-    # Convert into from numpy to torch tensor...
-    return torch.from_numpy(tokens).to(device), torch.from_numpy(tokens_pre).to(device), \
-           torch.from_numpy(tokens_alt).to(device), torch.from_numpy(tokens_cur).to(device),\
-           torch.from_numpy(cau_labels).to(device), torch.from_numpy(seq_lens).to(device), ids
+class BatchProvider(object):
+    """
+    Assembles batches straight out of the columnar records. The token columns, length and label of each row are
+    copied into one packed int32 host buffer (pinned when feeding a GPU), moved to the device in a single transfer
+    and split back into the per-field tensors the models expect.
+    """
+
+    def __init__(self, records, device, pin_memory=None, n_buffers=2):
+        self.records = records
+        self.device = torch.device(device)
+        self.total = len(records['id'])
+        # Pinned buffers and copy events only make sense for a cuda device, cpu training never pins...
+        self.pin_memory = self.device.type == 'cuda' if pin_memory is None else pin_memory
+        self.pin_memory = bool(self.pin_memory) and self.device.type == 'cuda'
+        self.fields = ['tokens', 'tokens_pre', 'tokens_alt', 'tokens_cur']
+        # Host buffers are used in turn, so a buffer is never refilled while its copy is still in flight...
+        self.n_buffers = n_buffers
+        self._buffers = [None] * n_buffers
+        self._events = [None] * n_buffers
+        self._slot = 0
+
+    def _get_buffer(self, slot, n, width):
+        if self._events[slot] is not None:
+            self._events[slot].synchronize()
+        # Buffers are kept flat, so a batch of any width is a contiguous view of the first n * width values...
+        buffer = self._buffers[slot]
+        if buffer is None or buffer.numel() < n * width:
+            buffer = torch.empty(n * width, dtype=torch.int32)
+            if self.pin_memory:
+                buffer = buffer.pin_memory()
+            self._buffers[slot] = buffer
+        return buffer[:n * width].view(n, width)
+
+    def pack(self, index, trim=False, slot=None):
+        """
+        Host side half of get, fills the packed buffer of slot. Only touches numpy and the records, so it can run
+        in a background thread while the model computes the previous batch.
+        """
+        if slot is None:
+            slot = self._slot
+            self._slot = (slot + 1) % self.n_buffers
+        if isinstance(index, slice):
+            index = slice(*index.indices(self.total))
+            n = max(0, index.stop - index.start)
+        else:
+            index = np.asarray(index)
+            n = len(index)
+        columns = [self.records[field][index] for field in self.fields]
+        lengths = self.records['length'][index]
+        if trim:
+            # The full sentence is cut to its longest row, a trailing <NULL> token has id 0 like the padding...
+            full_width = max(1, int(lengths.max())) if n > 0 else 1
+            columns = [columns[0][:, :full_width]] + [column[:, :used_width(column)] for column in columns[1:]]
+        widths = [column.shape[1] for column in columns] + [5]
+        offsets = np.cumsum([0] + widths)
+        buffer = self._get_buffer(slot, n, int(offsets[-1]))
+        packed = buffer.numpy()
+        for i, column in enumerate(columns):
+            packed[:, offsets[i]:offsets[i + 1]] = column
+        packed[:, -5] = lengths
+        packed[:, -4] = self.records['cau_label'][index]
+        packed[:, -3:] = self.records['seg_start'][index]
+        ids = self.records['id'][index].tolist()
+        return slot, buffer, widths, ids
+
+    def load(self, packed):
+        """
+        Device side half of get, moves a packed batch to the device and splits it into the model inputs.
+        """
+        slot, buffer, widths, ids = packed
+        # One host to device copy per batch, the cast to int64 then runs on the device...
+        batch = buffer.to(self.device, non_blocking=self.pin_memory)
+        if self.pin_memory:
+            self._events[slot] = torch.cuda.Event()
+            self._events[slot].record()
+        batch = batch.long()
+        tokens, tokens_pre, tokens_alt, tokens_cur, extra = torch.split(batch, widths, dim=1)
+        return tokens, tokens_pre, tokens_alt, tokens_cur, extra[:, 1], extra[:, 0], extra[:, 2:], ids
+
+    def get(self, index, trim=False):
+        """
+        index is a slice over a contiguous range of rows or an index array (e.g. a slice of a permutation).
+        With trim every token column is cut to the longest row of this batch instead of its full max_len.
+        Returns tokens, tokens_pre, tokens_alt, tokens_cur, cau_labels, seq_lens, seg_starts as int64 tensors on
+        the device together with the list of sample ids.
+        """
+        return self.load(self.pack(index, trim))
+
+
+def prefetch_batches(provider, batches, trim=False, num_threads=1):
+    """
+    Yields provider.get(batch, trim) for every batch in order, while up to num_threads following batches are
+    packed by background threads. Reading the memmaps and copying numpy arrays release the GIL, so the packing
+    overlaps with the forward and backward pass. The provider needs n_buffers >= num_threads + 2.
+    """
+    depth = max(0, min(num_threads, provider.n_buffers - 2))
+    if depth == 0:
+        for batch in batches:
+            yield provider.get(batch, trim)
+        return
+    executor = ThreadPoolExecutor(depth)
+    pending = deque()
+    try:
+        # Batch i always packs into slot i % n_buffers, the slot of batch i + depth was last used by i - 2...
+        for i in range(min(depth, len(batches))):
+            pending.append(executor.submit(provider.pack, batches[i], trim, i % provider.n_buffers))
+        for i in range(len(batches)):
+            loaded = provider.load(pending.popleft().result())
+            j = i + depth
+            if j < len(batches):
+                pending.append(executor.submit(provider.pack, batches[j], trim, j % provider.n_buffers))
+            yield loaded
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def used_width(column):
+    """
+    Number of leading columns holding at least one non zero id, used for the segment columns which have no stored
+    length. A segment that is a single <NULL> keeps its first column.
+    """
+    used = np.flatnonzero(column.any(axis=0))
+    return int(used[-1]) + 1 if len(used) > 0 else 1
+
+
+def bucket_batches(order, lengths, batch_size, pool_batches=50, rng=None):
+    """
+    Cuts an epoch order into batches of rows with similar length. The order is split into pools of pool_batches
+    batches, each pool is sorted by length and cut into batches, and the batches are shuffled again so the epoch
+    does not run from short to long. pool_batches <= 0 keeps the plain consecutive batches.
+    """
+    order = np.asarray(order)
+    if pool_batches <= 0:
+        return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+    batches = []
+    pool_size = batch_size * pool_batches
+    for start in range(0, len(order), pool_size):
+        pool = order[start:start + pool_size]
+        pool = pool[np.argsort(lengths[pool], kind='stable')]
+        batches.extend(pool[i:i + batch_size] for i in range(0, len(pool), batch_size))
+    rng = np.random if rng is None else rng
+    return [batches[i] for i in rng.permutation(len(batches))]
+
+
+def epoch_rng(seed, epoch, run=0):
+    """
+    RandomState of one epoch, seeded from the config seed so the data order of a run can be reproduced.
+    """
+    return np.random.RandomState([seed, run, epoch])
+
+
+def epoch_order(total, rng, shard=0, n_shards=1):
+    """
+    Sample order of an epoch as a permutation of row indices into the records, the records themselves are never
+    touched. With n_shards > 1 every process draws the same permutation from an equally seeded rng and keeps its
+    own contiguous share, all shards get total // n_shards rows so they run the same number of steps.
+    """
+    order = rng.permutation(total)
+    if n_shards > 1:
+        per_shard = total // n_shards
+        order = order[shard * per_shard:(shard + 1) * per_shard]
+    return order
+
+
+def length_batches(lengths, batch_size):
+    """
+    Evaluation batches over all rows sorted by length, so dynamic padding trims as much as possible.
+    """
+    order = np.argsort(lengths, kind='stable')
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def schedule_steps(train_num, batch_size, epochs, accumulate_steps=1):
+    # The scheduler steps with the optimizer, once every accumulate_steps micro-batches and at the end of an epoch...
+    return -(-(train_num // batch_size + 1) // max(1, accumulate_steps)) * epochs
+
+
+def dynamic_pad_enabled(model, dynamic_pad):
+    # Models that flatten max_len * hidden (TB, Hierarchical) set fixed_length and always get full width batches...
+    return dynamic_pad and not getattr(model, 'fixed_length', False)
+
+
+# Compute dtypes of the --precision choices, fp32 runs without autocast...
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def autocast(device, precision='fp32'):
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(torch.device(device).type, dtype=PRECISIONS[precision])
+
+
+def grad_scaler(device, precision='fp32'):
+    # Only float16 gradients underflow, bfloat16 has the exponent range of float32 and needs no loss scaling...
+    enabled = precision == 'fp16'
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(torch.device(device).type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def cast_frozen_embeddings(model, precision='fp32'):
+    """
+    Stores the frozen embedding tables in the compute dtype, which halves the memory read by every lookup. Tables
+    that are trained keep float32 master weights. Checkpoints stay loadable both ways, load_state_dict casts.
+    """
+    if precision == 'fp32':
+        return model
+    for module in model.modules():
+        if isinstance(module, torch.nn.Embedding) and not module.weight.requires_grad:
+            module.weight.data = module.weight.data.to(PRECISIONS[precision])
+    return model
+
+
+def share_frozen_embeddings(model, embeddings):
+    """
+    Points the frozen float32 embedding tables of a cpu model at the embeddings array itself instead of the copy
+    made by the model. With the memmap of shared_embeddings the processes of a parallel run read the same pages,
+    a frozen table is never written so they are never copied.
+    """
+    if not isinstance(embeddings, np.ndarray) or embeddings.dtype != np.float32:
+        return model
+    for module in model.modules():
+        if isinstance(module, torch.nn.Embedding) and not module.weight.requires_grad and \
+                module.weight.device.type == 'cpu' and tuple(module.weight.shape) == embeddings.shape:
+            module.weight.data = torch.from_numpy(embeddings)
+    return model
 
 
 def _sequence_mask(sequence_length, max_len=None):
@@ -88,32 +297,38 @@ def compute_loss(logits, target, length, weight):
     return loss
 
 # Evaluating the batch for valid files....
-def evaluate_batch(model, data_num, batch_size, eval_file, device, is_fc, data_type, logger):
+def evaluate_batch(model, data_num, batch_size, eval_file, device, is_fc, data_type, logger, dynamic_pad=False,
+                   precision='fp32'):
     losses = []
     fp, fn = [], []
     causality_preds, causality_scores, causality_labels = [], [], []
     metrics = {}
+    provider = BatchProvider(eval_file, device)
+    trim = dynamic_pad_enabled(model, dynamic_pad)
+    if trim:
+        batches = length_batches(np.asarray(eval_file['length'][:data_num]), batch_size)
+    else:
+        batches = [slice(start_idx, start_idx + batch_size) for start_idx in range(0, data_num, batch_size)]
     model.eval()
-    for batch_idx, batch in enumerate(range(0, data_num, batch_size)):
-        start_idx = batch
-        end_idx = start_idx + batch_size
-        tokens, tokens_pre, tokens_alt, tokens_cur, cau_labels, seq_lens, eids = get_batch(eval_file[start_idx:end_idx],
+    # is_fc mean focal loss....
+    if is_fc:
+        criterion = FocalLoss(gamma=2, alpha=0.75)
+    else:
+        criterion = torch.nn.CrossEntropyLoss()
+    for batch_idx, batch in enumerate(batches):
+        tokens, tokens_pre, tokens_alt, tokens_cur, cau_labels, seq_lens, seg_starts, eids = provider.get(batch, trim)
+        # cau_outputs mean predicted output, no graph is kept for evaluation....
+        with torch.no_grad(), autocast(device, precision):
+            cau_outputs = model(tokens, tokens_pre, tokens_alt, tokens_cur, seq_lens, seg_starts)
+        cau_outputs = cau_outputs.float()
 
-                                                                                   device)
-        # cau_outputs mean predicted output....
-        cau_outputs = model(tokens, tokens_pre, tokens_alt, tokens_cur, seq_lens)
-        cau_outputs = cau_outputs.detach()
-
-        # is_fc mean focal loss....
-        if is_fc:
-            criterion = FocalLoss(gamma=2, alpha=0.75)
-        else:
-            criterion = torch.nn.CrossEntropyLoss()
         loss = criterion(cau_outputs, cau_labels)
-        losses.append(loss.item())
+        losses.append(loss)
 
-        cau_preds = torch.max(cau_outputs.cpu(), 1)[1].numpy()
-        cau_scores = cau_outputs.cpu()[:, 1].numpy()
+        # One copy back to the host per batch for the outputs and one for the labels...
+        cau_outputs = cau_outputs.cpu()
+        cau_preds = torch.max(cau_outputs, 1)[1].numpy()
+        cau_scores = cau_outputs[:, 1].numpy()
         cau_labels = cau_labels.cpu().numpy()
 
         causality_preds += cau_preds.tolist()
@@ -128,7 +343,7 @@ def evaluate_batch(model, data_num, batch_size, eval_file, device, is_fc, data_t
                     fp.append(eid)
 
 # These commands are used for metrics evaluation, such as Auc_roc, aur_prc etc...
-    metrics['loss'] = np.mean(losses)
+    metrics['loss'] = torch.stack(losses).mean().item()
     metrics['acc'] = accuracy_score(causality_labels, causality_preds)
     metrics['precision'] = precision_score(causality_labels, causality_preds)
     metrics['recall'] = recall_score(causality_labels, causality_preds)
@@ -151,15 +366,16 @@ def evaluate_batch(model, data_num, batch_size, eval_file, device, is_fc, data_t
     return metrics, fpr, tpr, precisions, recalls
 
 # evaluation data file....
-def case_batch(model, data_num, batch_size, eval_file, device):
+def case_batch(model, data_num, batch_size, eval_file, device, precision='fp32'):
+    provider = BatchProvider(eval_file, device)
     model.eval()
     for batch_idx, batch in enumerate(range(0, data_num, batch_size)):
         start_idx = batch
         end_idx = start_idx + batch_size
-        tokens, tokens_pre, tokens_alt, tokens_cur, cau_labels, seq_lens, eids = get_batch(eval_file[start_idx:end_idx],
-                                                                                           device)
-        cau_outputs = model(tokens, tokens_pre, tokens_alt, tokens_cur, seq_lens)
-        cau_outputs = cau_outputs.detach()
+        tokens, tokens_pre, tokens_alt, tokens_cur, cau_labels, seq_lens, seg_starts, eids = provider.get(slice(start_idx, end_idx))
+        with torch.no_grad(), autocast(device, precision):
+            cau_outputs = model(tokens, tokens_pre, tokens_alt, tokens_cur, seq_lens, seg_starts)
+        cau_outputs = cau_outputs.detach().float()
 
         m = torch.nn.Softmax(dim=-1)
         cau_scores = m(cau_outputs).cpu().numpy()
@@ -186,17 +402,19 @@ class FocalLoss(torch.nn.Module):
             input = input.contiguous().view(-1, input.size(2))  # N,H*W,C => N*H*W,C
         target = target.view(-1, 1)
 
-        logpt = functional.log_softmax(input, dim=-1)
+        # Reduced precision logits are upcast, the loss and its gradient are always taken in float32...
+        logpt = functional.log_softmax(input.float(), dim=-1)
         logpt = logpt.gather(1, target)
         logpt = logpt.view(-1)
-        pt = logpt.exp()         # pt =positive true....
+        # pt =positive true, 1 - pt as -expm1(logpt) keeps its precision for well classified samples where pt rounds to 1...
+        one_minus_pt = -torch.expm1(logpt)
 
         if self.alpha is not None:
-            if self.alpha.type() != input.data.type():
-                self.alpha = self.alpha.type_as(input.data)
+            if self.alpha.type() != logpt.type():
+                self.alpha = self.alpha.type_as(logpt)
             at = self.alpha.gather(0, target.data.view(-1))
             logpt = logpt * Variable(at)
-        loss = -1 * (1 - pt) ** self.gamma * logpt
+        loss = -1 * one_minus_pt ** self.gamma * logpt
         if self.size_average:
             return loss.mean()
         else:
@@ -240,13 +458,15 @@ class NeuralFocal(torch.nn.Module):
 # This function is used to draw the attributes....
 
 def draw_att(model, data_num, batch_size, test_file, device, id2token_file, pics_dir, nblock, nhead, logger):
+    provider = BatchProvider(test_file, device)
     model.eval()
+    for block in model.transformer.blocks:
+        block.self_attn.capture = True
     for batch_idx, batch in enumerate(range(0, data_num, batch_size)):
         start_idx = batch
         end_idx = start_idx + batch_size
-        tokens, tokens_pre, tokens_alt, tokens_cur, cau_labels, seq_lens, eids = get_batch(test_file[start_idx:end_idx],
-                                                                                           device)
-        cau_outputs = model(tokens, tokens_pre, tokens_alt, tokens_cur, seq_lens)
+        tokens, tokens_pre, tokens_alt, tokens_cur, cau_labels, seq_lens, seg_starts, eids = provider.get(slice(start_idx, end_idx))
+        cau_outputs = model(tokens, tokens_pre, tokens_alt, tokens_cur, seq_lens, seg_starts)
         tokens = tokens.cpu().numpy()
         seq_lens = seq_lens.cpu().numpy()
         nbatch = len(tokens)
@@ -313,6 +533,48 @@ def load_json(file_path):
     f.close()
     return obj
 
+
+def shared_embeddings(emb_file):
+    """
+    The pickled embedding matrix as a copy-on-write memmap of a .npy written next to it, so the processes of a
+    parallel run share its pages instead of each unpickling a private copy. The .npy is rewritten when the pickle is
+    newer.
+    """
+    npy_file = os.path.splitext(emb_file)[0] + '.npy'
+    if not os.path.exists(npy_file) or os.path.getmtime(npy_file) < os.path.getmtime(emb_file):
+        with open(emb_file, 'rb') as fh:
+            token_embeddings = pkl.load(fh)
+        fh.close()
+        # Written under a temporary name first, a worker never opens a half written file...
+        tmp_file = npy_file + '.tmp.npy'
+        np.save(tmp_file, np.asarray(token_embeddings, dtype=np.float32))
+        os.replace(tmp_file, npy_file)
+    return np.load(npy_file, mmap_mode='c')
+
+
+def init_logger(log_path, name='Causality'):
+    """
+    The Causality logger writes to log_path when given and to the console otherwise, a worker process of a
+    parallel run tags its lines with its own name.
+    """
+    logger = logging.getLogger('Causality')
+    logger.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s - {} - %(levelname)s - %(message)s'.format(name))
+
+    # Whether to store logs...
+    if log_path:
+        file_handler = logging.FileHandler(log_path)
+        file_handler.setLevel(logging.INFO)
+        file_handler.setFormatter(formatter)
+        logger.addHandler(file_handler)
+    else:
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(logging.INFO)
+        console_handler.setFormatter(formatter)
+        logger.addHandler(console_handler)
+    return logger
+
+
 # df mean dataFrame,such as table format...
 def save_loss(train_loss, valid_loss, path):
     df = pd.DataFrame({'train': train_loss, 'valid': valid_loss})